@@ -0,0 +1,177 @@
+"""
+Local cache of approved answers to repeated client questions.
+
+Questions are normalized, cut into character shingles and reduced to a
+MinHash signature; an LSH band index finds near-duplicates without
+comparing against every entry. Entries are scoped by the lead's interest
+(the listing they asked about), expire after ANSWER_CACHE_TTL seconds and
+are evicted least-recently-used beyond ANSWER_CACHE_MAX_ENTRIES. An answer
+is only stored after it was sent, with the lead's first name swapped for a
+placeholder so it can be reused for someone else.
+"""
+import os, re, time, zlib, logging, threading
+from collections import OrderedDict
+from .intent_router import normalize_message
+
+logger = logging.getLogger(__name__)
+
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // BANDS
+SHINGLE_SIZE = 3
+_PRIME = (1 << 61) - 1
+_NAME_PLACEHOLDER = '\x00first_name\x00'
+
+# Fixed (a, b) pairs so signatures are stable across processes and restarts
+_PERMUTATIONS = [((i * 0x9E3779B97F4A7C15 + 0x632BE59BD9B4E019) % _PRIME | 1,
+                  (i * 0xC2B2AE3D27D4EB4F + 0x165667B19E3779F9) % _PRIME)
+                 for i in range(1, NUM_PERMUTATIONS + 1)]
+
+STOP_WORDS = frozenset(
+    "a an the is are was were be do does did to of for in on at it its this that there "
+    "what whats how hows and or any some i im me my you your we our can could would will please hi hey "
+    "have has got get with".split()
+)
+
+_QUESTION_START = re.compile(r"^(?:what|whats|how|hows|is|are|does|do|can|could|when|where|which|who|any)\b")
+
+_entries = OrderedDict()  # entry id -> entry dict, least recently used first
+_bands = {}               # (scope, band number, band values) -> set of entry ids
+_lock = threading.Lock()
+_next_id = [0]
+_stats = {'lookups': 0, 'hits': 0, 'stores': 0, 'evictions': 0, 'expired': 0, 'purged': 0}
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return float(default)
+
+def scope_for(lead):
+    """Cache scope for a lead: the listing or interest they asked about"""
+    return normalize_message(lead.get('interest') or '') or 'general'
+
+def is_question(message):
+    """Only standalone questions are worth caching answers for"""
+    text = normalize_message(message)
+    return bool(text) and ('?' in message or bool(_QUESTION_START.match(text)))
+
+def _shingles(message):
+    words = [w for w in normalize_message(message).split() if w not in STOP_WORDS]
+    text = ' '.join(words)
+    if len(text) <= SHINGLE_SIZE:
+        return {text} if text else set()
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+def minhash(message):
+    """MinHash signature of a message, or None if it has no content words"""
+    shingles = _shingles(message)
+    if not shingles:
+        return None
+    hashed = [zlib.crc32(s.encode('utf-8')) for s in shingles]
+    return tuple(min((a * h + b) % _PRIME for h in hashed) for a, b in _PERMUTATIONS)
+
+def _band_keys(scope, signature):
+    return [(scope, band, signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]) for band in range(BANDS)]
+
+def _similarity(sig_a, sig_b):
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / NUM_PERMUTATIONS
+
+def _remove(entry_id):
+    """Drop an entry from the LRU and the band index; caller holds _lock"""
+    entry = _entries.pop(entry_id, None)
+    if entry is None:
+        return
+    for key in _band_keys(entry['scope'], entry['signature']):
+        bucket = _bands.get(key)
+        if bucket is not None:
+            bucket.discard(entry_id)
+            if not bucket:
+                del _bands[key]
+
+def lookup_answer(message, lead):
+    """A cached answer to a near-duplicate question from the same scope, or None"""
+    if not is_question(message):
+        return None
+    signature = minhash(message)
+    if signature is None:
+        return None
+    scope = scope_for(lead)
+    threshold = _env_float('ANSWER_CACHE_THRESHOLD', 0.7)
+    ttl = _env_float('ANSWER_CACHE_TTL', 86400)
+    now = time.time()
+
+    with _lock:
+        _stats['lookups'] += 1
+        candidates = set()
+        for key in _band_keys(scope, signature):
+            candidates.update(_bands.get(key, ()))
+        best_id, best_score = None, threshold
+        for entry_id in candidates:
+            entry = _entries[entry_id]
+            if now - entry['created'] > ttl:
+                _remove(entry_id)
+                _stats['expired'] += 1
+                continue
+            score = _similarity(signature, entry['signature'])
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+        if best_id is None:
+            return None
+        _entries.move_to_end(best_id)
+        _stats['hits'] += 1
+        entry = _entries[best_id]
+
+    first_name = (lead.get('name') or '').split()
+    answer = entry['answer'].replace(_NAME_PLACEHOLDER, first_name[0] if first_name else 'there')
+    logger.info(f"Answer cache hit ({best_score:.2f}) for {message!r} ~ {entry['question']!r}")
+    return answer
+
+def remember_answer(message, lead, answer):
+    """Store an answer that was sent in reply to a question"""
+    if not answer or not is_question(message):
+        return
+    signature = minhash(message)
+    if signature is None:
+        return
+    first_name = (lead.get('name') or '').split()
+    if first_name:
+        answer = re.sub(rf"\b{re.escape(first_name[0])}\b", _NAME_PLACEHOLDER, answer)
+    scope = scope_for(lead)
+    max_entries = int(_env_float('ANSWER_CACHE_MAX_ENTRIES', 1000))
+
+    with _lock:
+        _next_id[0] += 1
+        entry_id = _next_id[0]
+        _entries[entry_id] = {'scope': scope, 'signature': signature, 'question': message,
+                              'answer': answer, 'created': time.time()}
+        for key in _band_keys(scope, signature):
+            _bands.setdefault(key, set()).add(entry_id)
+        _stats['stores'] += 1
+        while len(_entries) > max_entries:
+            _remove(next(iter(_entries)))
+            _stats['evictions'] += 1
+
+def purge_answer_cache(scope=None):
+    """Drop cached answers for one scope (listing/interest), or all of them"""
+    with _lock:
+        if scope is None:
+            removed = len(_entries)
+            _entries.clear()
+            _bands.clear()
+        else:
+            scope = normalize_message(scope) or 'general'
+            ids = [entry_id for entry_id, entry in _entries.items() if entry['scope'] == scope]
+            for entry_id in ids:
+                _remove(entry_id)
+            removed = len(ids)
+        _stats['purged'] += removed
+    logger.info(f"Purged {removed} cached answers" + (f" for {scope}" if scope else ""))
+    return removed
+
+def get_answer_cache_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['entries'] = len(_entries)
+    stats['hit_rate'] = stats['hits'] / stats['lookups'] if stats['lookups'] else 0.0
+    return stats
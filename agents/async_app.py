@@ -0,0 +1,217 @@
+"""
+Async serving mode: an ASGI app for uvicorn.
+
+`POST /sms` and `GET /api/events` are handled natively on the event loop.
+Generation uses the AsyncOpenAI client and sends go through
+`sms_dispatcher.dispatch_sms_async` (httpx), so a reply waiting on OpenAI or
+Textbelt costs a coroutine, not a worker. Everything else (dashboard, chat
+API, stats) is the Flask app, run on a thread pool of ASYNC_WSGI_THREADS.
+
+Bursts of texts are debounced per phone as in the threaded mode, but a newer
+text cancels the pending reply task outright, including an in-flight OpenAI
+request.
+
+    uvicorn agents.async_app:app --host 0.0.0.0 --port 8080
+"""
+import asyncio, json, logging, os
+from urllib.parse import parse_qsl
+from a2wsgi import WSGIMiddleware
+from dotenv import load_dotenv
+from .agent_notifier import notify_agent
+from .chat_storage import save_message
+from .events import subscribe_async, unsubscribe, next_event_async, format_sse, RESYNC
+from .intent_router import classify_intent
+from .message_sender import close_async_session
+from .message_writer import generate_followup_async, close_async_openai_client
+from .reply_listener import (app as flask_app, validate_textbelt_webhook, webhook_fields, route_auto_response,
+                             get_tone_sample, claim_auto_response, record_auto_response, FALLBACK_AUTO_RESPONSE,
+                             debounce_seconds)
+from .sms_dispatcher import dispatch_sms_async
+from .webhook_dedup import claim_message_id, release_message_id
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# phone -> {'items': [(text, message_id), ...], 'task': asyncio.Task} for replies not yet committed
+_bursts = {}
+# Strong references so running reply tasks aren't garbage collected
+_tasks = set()
+
+def _start_task(coro):
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+async def generate_auto_response_async(from_number, incoming_messages):
+    """generate_auto_response on the event loop; returns (response text or None, intent)"""
+    try:
+        lead, routed = await asyncio.to_thread(route_auto_response, from_number, incoming_messages)
+        if routed:
+            return routed
+        return await generate_followup_async(lead, get_tone_sample()), None
+    except Exception as e:
+        logger.error(f"Error generating auto-response: {e}")
+        return FALLBACK_AUTO_RESPONSE, 'fallback'
+
+async def reply_to_messages(from_number, messages, burst=None):
+    """Generate one reply to (text, message_id) messages, notify the agent, then send it"""
+    texts = [text for text, _ in messages]
+    message_id = messages[-1][1]
+    try:
+        logger.info(f"🤖 Generating automatic response to {len(texts)} message(s)...")
+        auto_response, intent = await generate_auto_response_async(from_number, texts)
+        if burst is not None and _bursts.get(from_number) is burst:
+            # The reply is committed; texts from here on start a new burst
+            del _bursts[from_number]
+        # Only a committed burst alerts the agent, so a cancelled one is never alerted twice
+        await asyncio.to_thread(notify_agent, from_number, "\n".join(texts))
+        if not auto_response:
+            return
+
+        should_send, outbox_key = await asyncio.to_thread(claim_auto_response, from_number, auto_response, message_id)
+        if not should_send:
+            return
+        logger.info(f"📤 Sending auto-response: {auto_response[:50]}...")
+        # The STOP confirmation is the one message an opted-out lead still gets
+        response_id = await dispatch_sms_async(from_number, auto_response, ignore_opt_out=(intent == 'opt_out'),
+                                               outbox_key=outbox_key)
+        question = texts[0] if len(texts) == 1 else None
+        await asyncio.to_thread(record_auto_response, response_id, from_number, question, auto_response, intent)
+    except asyncio.CancelledError:
+        logger.info(f"Discarding reply to {from_number}: superseded by newer messages")
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error replying to {from_number}: {e}", exc_info=True)
+
+async def _reply_when_quiet(from_number, burst, delay):
+    await asyncio.sleep(delay)
+    await reply_to_messages(from_number, list(burst['items']), burst)
+
+def schedule_reply(from_number, message_text, message_id):
+    """Start the reply task; texts within the debounce window share one reply"""
+    item = (message_text, message_id)
+    debounce = debounce_seconds()
+    if not debounce or classify_intent(message_text) in ('opt_out', 'opt_in'):
+        _start_task(reply_to_messages(from_number, [item]))
+        return
+    burst = _bursts.setdefault(from_number, {'items': [], 'task': None})
+    burst['items'].append(item)
+    if burst['task'] is not None:
+        # Cancel the pending (or generating) reply; the new task answers every text
+        burst['task'].cancel()
+    burst['task'] = _start_task(_reply_when_quiet(from_number, burst, debounce))
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            return body
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def _send_json(send, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def sms_reply_async(scope, receive, send):
+    """The /sms webhook: save the message, schedule the reply, acknowledge"""
+    try:
+        logger.info("🔔 SMS webhook called")
+        payload = await _read_body(receive)
+        headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+
+        # Validate webhook signature for security (relaxed for testing)
+        if not validate_textbelt_webhook(payload, headers.get('x-textbelt-signature')):
+            logger.error("Invalid webhook signature")
+
+        if headers.get('content-type', '').split(';')[0].strip().endswith('json'):
+            from_number, message_text, message_id = webhook_fields(json.loads(payload or b'{}'), True)
+        else:
+            form = dict(parse_qsl(payload.decode('utf-8', 'replace')))
+            from_number, message_text, message_id = webhook_fields(form, False)
+        logger.info(f"📱 Textbelt webhook - MessageID: {message_id}, From: {from_number}")
+
+        if not (from_number and message_text):
+            logger.warning(f"⚠️ Incomplete webhook data - from: {from_number}, text: {message_text}")
+            return await _send_json(send, 400, {'error': 'Missing required fields'})
+
+        # Textbelt retries webhooks; a messageId we already handled costs nothing
+        if not await asyncio.to_thread(claim_message_id, message_id):
+            logger.info(f"Ignoring duplicate webhook for message {message_id}")
+            return await _send_json(send, 200, {'success': True, 'message': 'Duplicate message ignored'})
+
+        logger.info(f"💬 SMS Reply from {from_number}: {message_text}")
+        if not await asyncio.to_thread(save_message, from_number, message_text, 'incoming', message_id):
+            # Nothing was stored, so let Textbelt's retry through
+            await asyncio.to_thread(release_message_id, message_id)
+            return await _send_json(send, 500, {'error': 'Could not store message'})
+        schedule_reply(from_number, message_text, message_id)
+        return await _send_json(send, 200, {'success': True, 'message': 'Message received'})
+    except Exception as e:
+        logger.error(f"❌ Error processing Textbelt webhook: {e}", exc_info=True)
+        return await _send_json(send, 500, {'error': 'Internal server error'})
+
+async def event_stream_async(scope, receive, send):
+    """/api/events as a coroutine per client instead of a thread"""
+    keepalive = float(os.getenv('SSE_KEEPALIVE_SECONDS', '15'))
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.create_task(watch_disconnect())
+    subscriber = subscribe_async()
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        await send({'type': 'http.response.body', 'body': b"retry: 5000\n\n", 'more_body': True})
+        while not disconnected.is_set():
+            event = await next_event_async(subscriber, keepalive)
+            if event is None:
+                chunk = ": keepalive\n\n"
+            elif event is RESYNC:
+                await send({'type': 'http.response.body', 'body': b"event: resync\ndata: {}\n\n"})
+                return
+            else:
+                chunk = format_sse(event)
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+    except OSError:
+        pass  # client went away mid-write
+    finally:
+        unsubscribe(subscriber)
+        watcher.cancel()
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Let replies already being generated go out before closing the clients
+            if _tasks:
+                await asyncio.wait(list(_tasks), timeout=float(os.getenv('ASYNC_SHUTDOWN_GRACE_SECONDS', '10')))
+            await close_async_openai_client()
+            await close_async_session()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+_wsgi_app = WSGIMiddleware(flask_app, workers=int(os.getenv('ASYNC_WSGI_THREADS', '16')))
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] == 'http':
+        if scope['path'] == '/sms' and scope['method'] == 'POST':
+            return await sms_reply_async(scope, receive, send)
+        if scope['path'] == '/api/events' and scope['method'] == 'GET':
+            return await event_stream_async(scope, receive, send)
+    await _wsgi_app(scope, receive, send)
@@ -0,0 +1,246 @@
+"""
+SQLite engine for chat storage.
+
+Keeps every conversation in one WAL-mode database instead of one JSON file
+per phone. Selected with CHAT_STORAGE_BACKEND=sqlite; `chat_storage` is the
+public API and calls into this module with already-cleaned phone keys.
+
+The `conversation_stats` table (message counts and last activity per phone)
+is kept for both backends, so the dashboard never reads histories.
+"""
+import os, logging, sqlite3, threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.path.join("chat_history", "chat.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    phone TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    message TEXT,
+    message_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_phone_ts ON messages (phone, timestamp);
+CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (message_id);
+CREATE TABLE IF NOT EXISTS conversation_stats (
+    phone TEXT PRIMARY KEY,
+    incoming INTEGER NOT NULL DEFAULT 0,
+    outgoing INTEGER NOT NULL DEFAULT 0,
+    last_activity TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_conversation_stats_activity ON conversation_stats (last_activity);
+CREATE TABLE IF NOT EXISTS summaries (
+    phone TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    through_timestamp TEXT NOT NULL
+);
+"""
+
+_local = threading.local()
+
+def get_db_path():
+    """Database location, read at runtime so .env overrides apply"""
+    return os.getenv('CHAT_DB_PATH', DEFAULT_DB_PATH)
+
+def get_connection():
+    """Return this thread's connection, opening and initialising it on first use"""
+    db_path = get_db_path()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.path == db_path:
+        return conn
+
+    db_dir = os.path.dirname(db_path)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir, exist_ok=True)
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    _local.conn = conn
+    _local.path = db_path
+    logger.debug(f"Opened chat database {db_path}")
+    return conn
+
+def _row_to_entry(row):
+    return {
+        'timestamp': row['timestamp'],
+        'direction': row['direction'],
+        'message': row['message'],
+        'message_id': row['message_id']
+    }
+
+def _bump_stats(conn, phone_key, entries):
+    """Add entries to a conversation's stats; False if it has no stats row yet"""
+    incoming = sum(1 for e in entries if e.get('direction') == 'incoming')
+    outgoing = sum(1 for e in entries if e.get('direction') == 'outgoing')
+    last_activity = max((e.get('timestamp') or '' for e in entries), default='')
+    cursor = conn.execute(
+        "UPDATE conversation_stats SET incoming = incoming + ?, outgoing = outgoing + ?, "
+        "last_activity = MAX(COALESCE(last_activity, ''), ?) WHERE phone = ?",
+        (incoming, outgoing, last_activity, phone_key)
+    )
+    return cursor.rowcount == 1
+
+def _recount_stats(conn, phone_key):
+    """Recompute a conversation's stats row from its stored messages"""
+    conn.execute(
+        "INSERT OR REPLACE INTO conversation_stats (phone, incoming, outgoing, last_activity) "
+        "SELECT ?, COALESCE(SUM(direction = 'incoming'), 0), COALESCE(SUM(direction = 'outgoing'), 0), MAX(timestamp) "
+        "FROM messages WHERE phone = ?",
+        (phone_key, phone_key)
+    )
+
+def insert_message(phone_key, entry):
+    """Append one message entry to a conversation"""
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO messages (phone, timestamp, direction, message, message_id) VALUES (?, ?, ?, ?, ?)",
+            (phone_key, entry['timestamp'], entry['direction'], entry['message'], entry['message_id'])
+        )
+        if not _bump_stats(conn, phone_key, [entry]):
+            _recount_stats(conn, phone_key)
+
+def insert_messages(phone_key, entries):
+    """Bulk-append message entries, used when importing file histories"""
+    conn = get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO messages (phone, timestamp, direction, message, message_id) VALUES (?, ?, ?, ?, ?)",
+            [(phone_key, e.get('timestamp'), e.get('direction'), e.get('message'), e.get('message_id')) for e in entries]
+        )
+        _recount_stats(conn, phone_key)
+
+def fetch_history(phone_key):
+    """All messages for a conversation, oldest first"""
+    rows = get_connection().execute(
+        "SELECT timestamp, direction, message, message_id FROM messages WHERE phone = ? ORDER BY timestamp, id",
+        (phone_key,)
+    )
+    return [_row_to_entry(row) for row in rows]
+
+def fetch_recent(phone_key, limit):
+    """The last `limit` messages for a conversation, oldest first"""
+    rows = get_connection().execute(
+        "SELECT timestamp, direction, message, message_id FROM messages WHERE phone = ? "
+        "ORDER BY timestamp DESC, id DESC LIMIT ?",
+        (phone_key, limit)
+    ).fetchall()
+    return [_row_to_entry(row) for row in reversed(rows)]
+
+def fetch_page(phone_key, limit=None, before=None, since=None):
+    """
+    One page of a conversation, oldest first: messages after `since` (oldest
+    `limit` of them) or before `before` (newest `limit`). Returns
+    (messages, has_more).
+    """
+    conditions, params = ["phone = ?"], [phone_key]
+    if since is not None:
+        conditions.append("timestamp > ?")
+        params.append(since)
+    if before is not None:
+        conditions.append("timestamp < ?")
+        params.append(before)
+    order = "ASC" if since is not None else "DESC"
+    query = (f"SELECT timestamp, direction, message, message_id FROM messages WHERE {' AND '.join(conditions)} "
+             f"ORDER BY timestamp {order}, id {order}")
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit + 1)
+    rows = get_connection().execute(query, params).fetchall()
+    has_more = limit is not None and len(rows) > limit
+    rows = rows[:limit] if limit is not None else rows
+    if order == "DESC":
+        rows.reverse()
+    return [_row_to_entry(row) for row in rows], has_more
+
+def fetch_version(phone_key):
+    """A value that changes whenever a conversation gains a message"""
+    row = get_connection().execute(
+        "SELECT COUNT(*), MAX(id) FROM messages WHERE phone = ?", (phone_key,)
+    ).fetchone()
+    return f"{row[0]}-{row[1]}" if row[0] else None
+
+def fetch_summary(phone_key):
+    """Stored rolling summary for a conversation, or None"""
+    row = get_connection().execute(
+        "SELECT summary, through_timestamp FROM summaries WHERE phone = ?", (phone_key,)
+    ).fetchone()
+    return {'summary': row['summary'], 'through': row['through_timestamp']} if row else None
+
+def store_summary(phone_key, summary, through):
+    """Insert or replace a conversation's rolling summary"""
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO summaries (phone, summary, through_timestamp) VALUES (?, ?, ?) "
+            "ON CONFLICT(phone) DO UPDATE SET summary = excluded.summary, through_timestamp = excluded.through_timestamp",
+            (phone_key, summary, through)
+        )
+
+def has_phone_key(phone_key):
+    """Whether a conversation has any messages"""
+    row = get_connection().execute("SELECT 1 FROM messages WHERE phone = ? LIMIT 1", (phone_key,)).fetchone()
+    return row is not None
+
+def fetch_phone_keys():
+    """Every phone key that has at least one message"""
+    rows = get_connection().execute("SELECT DISTINCT phone FROM messages ORDER BY phone")
+    return [row['phone'] for row in rows]
+
+def record_stats(phone_key, entries):
+    """
+    Count entries appended to a file-backed conversation. Returns False if the
+    conversation has no stats row yet; the caller seeds it with store_stats.
+    """
+    conn = get_connection()
+    with conn:
+        return _bump_stats(conn, phone_key, entries)
+
+def store_stats(phone_key, incoming, outgoing, last_activity):
+    """Replace a conversation's stats row"""
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO conversation_stats (phone, incoming, outgoing, last_activity) VALUES (?, ?, ?, ?)",
+            (phone_key, incoming, outgoing, last_activity)
+        )
+
+def fetch_stats(phone_keys):
+    """Stats rows for the given phone keys, as {phone_key: {...}}"""
+    phone_keys = list(phone_keys)
+    stats = {}
+    conn = get_connection()
+    for start in range(0, len(phone_keys), 500):
+        chunk = phone_keys[start:start + 500]
+        rows = conn.execute(
+            f"SELECT phone, incoming, outgoing, last_activity FROM conversation_stats "
+            f"WHERE phone IN ({','.join('?' for _ in chunk)})",
+            chunk
+        )
+        for row in rows:
+            stats[row['phone']] = {'incoming': row['incoming'], 'outgoing': row['outgoing'],
+                                   'last_activity': row['last_activity']}
+    return stats
+
+def fetch_phone_keys_by_activity():
+    """Phone keys with stats, most recently active first"""
+    rows = get_connection().execute("SELECT phone FROM conversation_stats ORDER BY last_activity DESC")
+    return [row['phone'] for row in rows]
+
+def rebuild_stats_from_messages():
+    """Recompute every stats row from the messages table; returns the row count"""
+    conn = get_connection()
+    with conn:
+        conn.execute("DELETE FROM conversation_stats")
+        conn.execute(
+            "INSERT INTO conversation_stats (phone, incoming, outgoing, last_activity) "
+            "SELECT phone, SUM(direction = 'incoming'), SUM(direction = 'outgoing'), MAX(timestamp) "
+            "FROM messages GROUP BY phone"
+        )
+    return conn.execute("SELECT COUNT(*) FROM conversation_stats").fetchone()[0]
@@ -1,49 +1,721 @@
 """
 Simple chat storage system for tracking SMS conversations
+
+Each conversation is an append-only JSON Lines log, one message per line,
+so saving a message never rewrites the history. Logs are sharded by a hash
+prefix of the phone (`chat_history/<xx>/chat_<phone>.jsonl`) so no single
+directory grows with the number of leads, and `chat_history/phones.idx`
+lists every phone with history; it is appended to when a conversation is
+created, so enumeration and "has history" checks never list directories.
+
+Files from older layouts (flat `chat_<phone>.jsonl`, or `chat_<phone>.json`
+arrays) are still read, and are moved into their shard the first time a new
+message is saved for that phone (or all at once with `migrate_chat_files`).
+
+Conversations idle for longer than CHAT_COLD_AFTER_DAYS are moved by
+`compact_idle_conversations` into a gzipped cold tier
+(`chat_history/cold/<xx>/chat_<phone>.jsonl.gz`) with duplicate deliveries
+removed. Reads handle either tier; the next saved message brings the
+conversation back to the hot tier.
+
+Next to each log, `chat_<phone>.summary.json` holds the rolling summary of
+turns that no longer fit in the prompt (see `message_writer`).
+
+Set CHAT_STORAGE_BACKEND=sqlite to keep all conversations in a single
+SQLite database instead (see `chat_db`); the functions below keep the same
+signatures for either backend.
+
+Per-conversation message counts and last activity are kept in the SQLite
+`conversation_stats` table for both backends, updated on every
+`save_message`, so the dashboard never parses histories.
+`rebuild_conversation_stats` recounts them from scratch. Each saved
+message and the updated counters are also published to `events` for the
+live dashboard.
+
+Parsed JSONL histories are kept in a bounded in-process LRU cache
+(CHAT_CACHE_MAX_BYTES, default 8 MB, 0 disables). Entries are validated
+against the log's mtime and size on every read, so appends made by other
+gunicorn workers are picked up, and this process's own appends update the
+cached copy in place.
+
+Writers take a per-conversation advisory lock (a sidecar file under
+`chat_history/.locks/`, flock'ed on POSIX) and any whole-file rewrite goes
+through a temp file plus rename, so several gunicorn workers and threads
+can write the same conversation without losing or tearing messages.
 """
+import bisect
+import gzip
+import hashlib
 import json
 import os
 import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import time
 from datetime import datetime
+from . import chat_db, events
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locks only
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
 CHAT_STORAGE_DIR = "chat_history"
+PHONE_INDEX_NAME = "phones.idx"
+COLD_TIER_NAME = "cold"
+
+DEFAULT_COLD_AFTER_DAYS = 30
+
+DEFAULT_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# chat file -> (file signature, history list, size in bytes), least recent first
+_history_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+# Used instead of flock where fcntl is unavailable
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+# In-memory copy of phones.idx, refreshed by reading only the appended tail
+_phone_index = {'inode': None, 'offset': 0, 'phones': set()}
+_phone_index_lock = threading.Lock()
+
+def use_sqlite_backend():
+    """Whether CHAT_STORAGE_BACKEND selects the SQLite engine"""
+    return os.getenv('CHAT_STORAGE_BACKEND', 'file').lower() == 'sqlite'
 
 def ensure_storage_dir():
     """Ensure the chat storage directory exists"""
     if not os.path.exists(CHAT_STORAGE_DIR):
         os.makedirs(CHAT_STORAGE_DIR)
 
+def clean_phone_number(phone_number):
+    """Strip + and separators so the phone can be used in a filename"""
+    return phone_number.replace('+', '').replace('-', '').replace(' ', '')
+
+def phone_from_clean(clean_phone):
+    """Rebuild a +E.164 style phone from its cleaned form"""
+    # Add + back for US numbers
+    if len(clean_phone) == 11 and clean_phone.startswith('1'):
+        return f"+{clean_phone}"
+    elif len(clean_phone) == 10:
+        return f"+1{clean_phone}"
+    return f"+{clean_phone}"
+
+def shard_for(clean_phone):
+    """Two hex digits of the phone's hash, naming its shard directory"""
+    return hashlib.sha1(clean_phone.encode('utf-8')).hexdigest()[:2]
+
 def get_chat_file(phone_number):
-    """Get the chat file path for a phone number"""
-    # Clean phone number for filename (remove + and other chars)
-    clean_phone = phone_number.replace('+', '').replace('-', '').replace(' ', '')
-    return os.path.join(CHAT_STORAGE_DIR, f"chat_{clean_phone}.json")
+    """Get the chat log path for a phone number"""
+    clean_phone = clean_phone_number(phone_number)
+    return os.path.join(CHAT_STORAGE_DIR, shard_for(clean_phone), f"chat_{clean_phone}.jsonl")
+
+def get_flat_chat_file(phone_number):
+    """Get the pre-sharding chat log path for a phone number"""
+    return os.path.join(CHAT_STORAGE_DIR, f"chat_{clean_phone_number(phone_number)}.jsonl")
+
+def get_legacy_chat_file(phone_number):
+    """Get the pre-JSONL chat file path for a phone number"""
+    return os.path.join(CHAT_STORAGE_DIR, f"chat_{clean_phone_number(phone_number)}.json")
+
+def get_cold_chat_file(phone_number):
+    """Get the compressed cold-tier path for a phone number"""
+    clean_phone = clean_phone_number(phone_number)
+    return os.path.join(CHAT_STORAGE_DIR, COLD_TIER_NAME, shard_for(clean_phone), f"chat_{clean_phone}.jsonl.gz")
+
+def get_summary_file(phone_number):
+    """Get the rolling conversation summary path for a phone number"""
+    clean_phone = clean_phone_number(phone_number)
+    return os.path.join(CHAT_STORAGE_DIR, shard_for(clean_phone), f"chat_{clean_phone}.summary.json")
+
+def get_phone_index_file():
+    """Get the path of the persistent phone index"""
+    return os.path.join(CHAT_STORAGE_DIR, PHONE_INDEX_NAME)
+
+def _find_chat_file(phone_number):
+    """
+    Locate a conversation's file, preferring the current layout.
+    Returns (path, 'jsonl', 'cold' or 'json'), or (None, None) if there is none.
+    """
+    for path, kind in ((get_chat_file(phone_number), 'jsonl'),
+                       (get_cold_chat_file(phone_number), 'cold'),
+                       (get_flat_chat_file(phone_number), 'jsonl'),
+                       (get_legacy_chat_file(phone_number), 'json')):
+        if os.path.exists(path):
+            return path, kind
+    return None, None
+
+def _iter_chat_files():
+    """
+    Yield (clean phone, path, kind) for every conversation file on disk, in
+    the sharded, cold and older flat layouts. Used by maintenance tasks only.
+    """
+    if not os.path.isdir(CHAT_STORAGE_DIR):
+        return
+    for entry in os.scandir(CHAT_STORAGE_DIR):
+        if entry.is_dir() and len(entry.name) == 2:
+            for shard_entry in os.scandir(entry.path):
+                if shard_entry.name.startswith('chat_') and shard_entry.name.endswith('.jsonl'):
+                    yield shard_entry.name[5:-6], shard_entry.path, 'jsonl'
+        elif entry.is_dir() and entry.name == COLD_TIER_NAME:
+            for shard in os.scandir(entry.path):
+                if not shard.is_dir():
+                    continue
+                for cold_entry in os.scandir(shard.path):
+                    if cold_entry.name.startswith('chat_') and cold_entry.name.endswith('.jsonl.gz'):
+                        yield cold_entry.name[5:-9], cold_entry.path, 'cold'
+        elif entry.name.startswith('chat_'):
+            if entry.name.endswith('.jsonl'):
+                yield entry.name[5:-6], entry.path, 'jsonl'
+            elif entry.name.endswith('.json'):
+                yield entry.name[5:-5], entry.path, 'json'
+
+def get_lock_file(phone_number):
+    """Get the advisory lock file path for a phone number's conversation"""
+    clean_phone = clean_phone_number(phone_number)
+    return os.path.join(CHAT_STORAGE_DIR, '.locks', shard_for(clean_phone), f"{clean_phone}.lock")
+
+def conversation_lock(phone_number):
+    """Hold an exclusive lock on one conversation across processes and threads"""
+    return _file_lock(get_lock_file(phone_number))
+
+def _phone_index_file_lock():
+    return _file_lock(os.path.join(CHAT_STORAGE_DIR, '.locks', 'phones.idx.lock'))
+
+@contextmanager
+def _file_lock(lock_file):
+    """Exclusive advisory lock on a sidecar lock file"""
+    if fcntl is None:
+        with _thread_locks_guard:
+            lock = _thread_locks.setdefault(lock_file, threading.Lock())
+        with lock:
+            yield
+        return
+
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    with open(lock_file, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def _atomic_write(path, data):
+    """Replace a file's contents via a synced temp file and rename"""
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_', suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _encode_entries(entries):
+    """Serialize message entries as compact JSONL bytes"""
+    return b''.join(
+        (json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        for entry in entries
+    )
+
+def _open_chat_log(chat_file):
+    """Open a hot or gzipped cold chat log for reading as text"""
+    if chat_file.endswith('.gz'):
+        return gzip.open(chat_file, 'rt', encoding='utf-8')
+    return open(chat_file, 'r', encoding='utf-8')
+
+def _read_chat_log(chat_file):
+    """Read every message from a JSONL chat log, skipping unreadable lines"""
+    history = []
+    with _open_chat_log(chat_file) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                history.append(json.loads(line))
+            except ValueError:
+                logger.warning(f"Skipping malformed line {line_number} in {chat_file}")
+    return history
+
+def _get_cache_max_bytes():
+    try:
+        return int(os.getenv('CHAT_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES))
+    except ValueError:
+        return DEFAULT_CACHE_MAX_BYTES
+
+def _file_signature(path):
+    """(mtime, size) of a file, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _cache_get(chat_file, signature, count_miss=True):
+    """Cached history for a chat file if it still matches the file on disk"""
+    with _cache_lock:
+        cached = _history_cache.get(chat_file)
+        if cached is not None and cached[0] == signature:
+            _history_cache.move_to_end(chat_file)
+            _cache_stats['hits'] += 1
+            return cached[1]
+        if count_miss:
+            _cache_stats['misses'] += 1
+        return None
+
+def _cache_put(chat_file, signature, history):
+    """Store a parsed history, evicting least recently used entries to fit"""
+    max_bytes = _get_cache_max_bytes()
+    size = signature[1]
+    with _cache_lock:
+        _cache_discard(chat_file)
+        if size > max_bytes:
+            return
+        _history_cache[chat_file] = (signature, history, size)
+        _cache_stats['bytes'] += size
+        _cache_evict(max_bytes)
+
+def _cache_evict(max_bytes):
+    """Evict least recently used entries until the cache fits; caller holds _cache_lock"""
+    while _cache_stats['bytes'] > max_bytes and _history_cache:
+        _, (_, _, evicted_size) = _history_cache.popitem(last=False)
+        _cache_stats['bytes'] -= evicted_size
+        _cache_stats['evictions'] += 1
+
+def _cache_discard(chat_file):
+    """Drop a cache entry; caller holds _cache_lock"""
+    cached = _history_cache.pop(chat_file, None)
+    if cached is not None:
+        _cache_stats['bytes'] -= cached[2]
+
+def _cache_append(chat_file, old_signature, new_signature, entry, line_bytes):
+    """
+    Write-through for an append: extend the cached history if it was current
+    before the append and nothing else was written alongside it, else drop it.
+    """
+    max_bytes = _get_cache_max_bytes()
+    with _cache_lock:
+        cached = _history_cache.get(chat_file)
+        if cached is None:
+            return
+        if (cached[0] != old_signature or new_signature is None
+                or new_signature[1] != old_signature[1] + line_bytes):
+            _cache_discard(chat_file)
+            return
+        cached[1].append(entry)
+        _history_cache[chat_file] = (new_signature, cached[1], new_signature[1])
+        _cache_stats['bytes'] += line_bytes
+        _history_cache.move_to_end(chat_file)
+        _cache_evict(max_bytes)
+
+def _load_cached_chat_log(chat_file):
+    """Parsed JSONL history, served from the cache when the file is unchanged"""
+    signature = _file_signature(chat_file)
+    if signature is None:
+        return None
+    history = _cache_get(chat_file, signature)
+    if history is None:
+        history = _read_chat_log(chat_file)
+        # An append that landed mid-read would be cached under the old
+        # signature and then appended again by the write-through
+        if _file_signature(chat_file) == signature:
+            _cache_put(chat_file, signature, history)
+    return history
+
+def get_cache_stats():
+    """Hit/miss counters and current size of the chat history cache"""
+    with _cache_lock:
+        stats = dict(_cache_stats)
+        stats['entries'] = len(_history_cache)
+    stats['max_bytes'] = _get_cache_max_bytes()
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+def clear_cache():
+    """Empty the chat history cache and reset its counters"""
+    with _cache_lock:
+        _history_cache.clear()
+        _cache_stats.update(hits=0, misses=0, evictions=0, bytes=0)
+
+def _read_chat_log_tail(chat_file, count, block_size=8192):
+    """
+    Read the last `count` messages of a JSONL chat log by seeking backwards
+    from the end of the file, so only the tail is read and parsed.
+    """
+    entries = []
+    with open(chat_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b''
+        while position > 0 and len(entries) < count:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            chunk = f.read(read_size) + remainder
+            lines = chunk.split(b'\n')
+            # The first piece may be a partial line unless we hit the start
+            remainder = lines.pop(0) if position > 0 else b''
+            for line in reversed(lines):
+                if len(entries) >= count:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line.decode('utf-8')))
+                except ValueError:
+                    logger.warning(f"Skipping malformed line in {chat_file}")
+    entries.reverse()
+    return entries
+
+def _read_legacy_chat_file(legacy_file):
+    """Read a pre-JSONL chat file holding a single JSON array"""
+    with open(legacy_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _convert_legacy_chat_file(legacy_file, chat_file):
+    """
+    Rewrite a legacy JSON array file as a JSONL log and remove the original.
+    Caller holds the conversation lock. An unreadable legacy file is set
+    aside as `.corrupt` instead of being silently treated as empty.
+    """
+    try:
+        history = _read_legacy_chat_file(legacy_file)
+    except ValueError as e:
+        logger.error(f"Unreadable chat file {legacy_file} ({e}); moving it to {legacy_file}.corrupt")
+        os.replace(legacy_file, legacy_file + '.corrupt')
+        return 0
+    _atomic_write(chat_file, _encode_entries(history))
+    os.remove(legacy_file)
+    return len(history)
+
+def _append_line(chat_file, line):
+    """
+    Append one encoded line to a chat log; caller holds the conversation lock.
+    If a previous writer died mid-line, terminate that fragment first so it
+    cannot swallow this message. Returns the number of bytes written.
+    """
+    with open(chat_file, 'a+b') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                line = b'\n' + line
+        f.write(line)
+        f.flush()
+    return len(line)
+
+def _adopt_older_chat_file(phone_number, chat_file):
+    """
+    Move a conversation stored in the cold tier or an older layout into its
+    hot shard; caller holds the conversation lock. Returns True if a file
+    was adopted.
+    """
+    if os.path.exists(chat_file):
+        return False
+    cold_file = get_cold_chat_file(phone_number)
+    if os.path.exists(cold_file):
+        os.makedirs(os.path.dirname(chat_file), exist_ok=True)
+        with gzip.open(cold_file, 'rb') as f:
+            _atomic_write(chat_file, f.read())
+        os.remove(cold_file)
+        with _cache_lock:
+            _cache_discard(cold_file)
+        return True
+    flat_file = get_flat_chat_file(phone_number)
+    legacy_file = get_legacy_chat_file(phone_number)
+    if os.path.exists(flat_file):
+        os.makedirs(os.path.dirname(chat_file), exist_ok=True)
+        os.replace(flat_file, chat_file)
+        return True
+    if os.path.exists(legacy_file):
+        os.makedirs(os.path.dirname(chat_file), exist_ok=True)
+        _convert_legacy_chat_file(legacy_file, chat_file)
+        return True
+    return False
+
+def rebuild_phone_index():
+    """Rewrite phones.idx from the conversation files on disk"""
+    ensure_storage_dir()
+    with _phone_index_file_lock():
+        clean_phones = sorted({clean_phone for clean_phone, _, _ in _iter_chat_files()})
+        _atomic_write(get_phone_index_file(), ''.join(f"{p}\n" for p in clean_phones).encode('utf-8'))
+    logger.info(f"Rebuilt phone index with {len(clean_phones)} conversations")
+    return len(clean_phones)
+
+def _add_to_phone_index(clean_phone):
+    """Record a newly created conversation in phones.idx"""
+    index_file = get_phone_index_file()
+    if not os.path.exists(index_file):
+        rebuild_phone_index()  # scans disk, so it already includes this phone
+        return
+    with _phone_index_file_lock():
+        with open(index_file, 'a', encoding='utf-8') as f:
+            f.write(f"{clean_phone}\n")
+
+def _refresh_phone_index():
+    """Bring the in-memory phone set up to date, reading only new index lines"""
+    index_file = get_phone_index_file()
+    if not os.path.exists(index_file):
+        rebuild_phone_index()
+    with _phone_index_lock:
+        with open(index_file, 'rb') as f:
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != _phone_index['inode']:
+                # Rebuilt (renamed into place) since we last read it
+                _phone_index.update(inode=inode, offset=0, phones=set())
+            f.seek(_phone_index['offset'])
+            data = f.read()
+        complete = data.rfind(b'\n') + 1  # ignore a line still being written
+        for line in data[:complete].split(b'\n'):
+            if line:
+                _phone_index['phones'].add(line.decode('utf-8'))
+        _phone_index['offset'] += complete
+        return _phone_index['phones']
+
+def has_chat_history(phone_number):
+    """Whether any messages are stored for a phone number"""
+    try:
+        clean_phone = clean_phone_number(phone_number)
+        if use_sqlite_backend():
+            return chat_db.has_phone_key(clean_phone)
+        if clean_phone in _refresh_phone_index():
+            return True
+        # Not indexed yet only if another process is mid-write; check the disk
+        return _find_chat_file(phone_number)[0] is not None
+    except Exception as e:
+        logger.error(f"Error checking chat history for {phone_number}: {e}")
+        return False
+
+def iter_phone_numbers():
+    """Stream every phone number that has chat history"""
+    if use_sqlite_backend():
+        for key in chat_db.fetch_phone_keys():
+            yield phone_from_clean(key)
+        return
+    index_file = get_phone_index_file()
+    if not os.path.exists(index_file):
+        rebuild_phone_index()
+    seen = set()
+    with open(index_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            clean_phone = line.strip()
+            if clean_phone and clean_phone not in seen:
+                seen.add(clean_phone)
+                yield phone_from_clean(clean_phone)
 
 def load_chat_history(phone_number):
     """Load chat history for a phone number"""
     try:
-        chat_file = get_chat_file(phone_number)
-        if os.path.exists(chat_file):
-            with open(chat_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+        if use_sqlite_backend():
+            return chat_db.fetch_history(clean_phone_number(phone_number))
+        path, kind = _find_chat_file(phone_number)
+        if kind in ('jsonl', 'cold'):
+            history = _load_cached_chat_log(path)
+            return list(history) if history is not None else []
+        if kind == 'json':
+            return _read_legacy_chat_file(path)
         return []
     except Exception as e:
         logger.error(f"Error loading chat history for {phone_number}: {e}")
         return []
 
+def load_recent_messages(phone_number, n):
+    """Load only the last `n` messages for a phone number, oldest first"""
+    if n <= 0:
+        return []
+    try:
+        if use_sqlite_backend():
+            return chat_db.fetch_recent(clean_phone_number(phone_number), n)
+        path, kind = _find_chat_file(phone_number)
+        if kind == 'jsonl':
+            # A cached history is cheaper than a tail read; a miss stays a tail read
+            history = _cache_get(path, _file_signature(path), count_miss=False)
+            if history is not None:
+                return history[-n:]
+            return _read_chat_log_tail(path, n)
+        if kind == 'cold':
+            history = _load_cached_chat_log(path)
+            return history[-n:] if history is not None else []
+        if kind == 'json':
+            return _read_legacy_chat_file(path)[-n:]
+        return []
+    except Exception as e:
+        logger.error(f"Error loading recent messages for {phone_number}: {e}")
+        return []
+
+def get_chat_version(phone_number):
+    """
+    Opaque version of a conversation that changes on every new message
+    (file mtime/size, or message count for SQLite); None if there is none.
+    """
+    try:
+        if use_sqlite_backend():
+            return chat_db.fetch_version(clean_phone_number(phone_number))
+        path, kind = _find_chat_file(phone_number)
+        signature = _file_signature(path) if kind else None
+        return f"{kind}-{signature[0]}-{signature[1]}" if signature else None
+    except Exception as e:
+        logger.error(f"Error reading chat version for {phone_number}: {e}")
+        return None
+
+def load_chat_page(phone_number, limit=None, before=None, since=None):
+    """
+    Page through a conversation by timestamp cursor. With `since`, returns
+    the oldest `limit` messages newer than it; otherwise the newest `limit`
+    messages (older than `before`, if given). Messages are oldest first.
+    Returns (messages, has_more).
+    """
+    try:
+        if use_sqlite_backend():
+            return chat_db.fetch_page(clean_phone_number(phone_number), limit, before, since)
+        if limit is not None and before is None and since is None:
+            # The latest page is a tail read, not a full parse
+            messages = load_recent_messages(phone_number, limit + 1)
+            return messages[-limit:] if limit else [], len(messages) > limit
+        history = load_chat_history(phone_number)
+        timestamps = [msg.get('timestamp', '') for msg in history]
+        start = bisect.bisect_right(timestamps, since) if since is not None else 0
+        end = bisect.bisect_left(timestamps, before) if before is not None else len(history)
+        if limit is None or end - start <= limit:
+            return history[start:end], False
+        if since is not None:
+            return history[start:start + limit], True
+        return history[end - limit:end], True
+    except Exception as e:
+        logger.error(f"Error loading chat page for {phone_number}: {e}")
+        return [], False
+
+def load_summary(phone_number):
+    """
+    Rolling summary of a conversation's older turns, as
+    {'summary': text, 'through': timestamp of the last folded message}, or None.
+    """
+    try:
+        if use_sqlite_backend():
+            return chat_db.fetch_summary(clean_phone_number(phone_number))
+        summary_file = get_summary_file(phone_number)
+        if not os.path.exists(summary_file):
+            return None
+        with open(summary_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Error loading summary for {phone_number}: {e}")
+        return None
+
+def save_summary(phone_number, summary, through):
+    """Store a conversation's rolling summary, replacing the previous one"""
+    try:
+        if use_sqlite_backend():
+            chat_db.store_summary(clean_phone_number(phone_number), summary, through)
+            return
+        summary_file = get_summary_file(phone_number)
+        os.makedirs(os.path.dirname(summary_file), exist_ok=True)
+        data = json.dumps({'summary': summary, 'through': through}, ensure_ascii=False)
+        _atomic_write(summary_file, data.encode('utf-8'))
+    except Exception as e:
+        logger.error(f"Error saving summary for {phone_number}: {e}")
+
+def _history_stats(history):
+    """(incoming, outgoing, last activity) counted from a parsed history"""
+    incoming = sum(1 for msg in history if msg.get('direction') == 'incoming')
+    outgoing = sum(1 for msg in history if msg.get('direction') == 'outgoing')
+    last_activity = max((msg.get('timestamp') or '' for msg in history), default=None) or None
+    return incoming, outgoing, last_activity
+
+def _refresh_conversation_stats(phone_number):
+    """Recount a file-backed conversation into the stats table"""
+    history = load_chat_history(phone_number)
+    chat_db.store_stats(clean_phone_number(phone_number), *_history_stats(history))
+
+def _record_conversation_stats(phone_number, message_entry):
+    """Count an appended message; the first message since stats existed seeds a full recount"""
+    try:
+        if not chat_db.record_stats(clean_phone_number(phone_number), [message_entry]):
+            _refresh_conversation_stats(phone_number)
+    except Exception as e:
+        # The message is saved; rebuild-stats repairs the counters
+        logger.error(f"Error updating conversation stats for {phone_number}: {e}")
+
+def get_conversation_stats(phone_numbers):
+    """
+    Message counts and last activity for the given phones, as
+    {phone: {'incoming', 'outgoing', 'last_activity'}}; phones without
+    history are left out. Reads only the stats table, never a history.
+    """
+    try:
+        keys = {clean_phone_number(phone): phone for phone in phone_numbers}
+        stats = chat_db.fetch_stats(keys)
+        # Conversations from before stats were kept are counted once, on first view
+        for key, phone in keys.items():
+            if key not in stats and has_chat_history(phone):
+                if use_sqlite_backend():
+                    chat_db.rebuild_stats_from_messages()
+                    stats.update(chat_db.fetch_stats([k for k in keys if k not in stats]))
+                    break
+                _refresh_conversation_stats(phone)
+                stats.update(chat_db.fetch_stats([key]))
+        return {keys[key]: value for key, value in stats.items()}
+    except Exception as e:
+        logger.error(f"Error loading conversation stats: {e}")
+        return {}
+
+def recent_conversation_phones():
+    """Phones with history, most recently active first"""
+    try:
+        return [phone_from_clean(key) for key in chat_db.fetch_phone_keys_by_activity()]
+    except Exception as e:
+        logger.error(f"Error loading conversation activity: {e}")
+        return []
+
+def rebuild_conversation_stats():
+    """Recompute the stats table from every stored history; returns the conversation count"""
+    if use_sqlite_backend():
+        return chat_db.rebuild_stats_from_messages()
+    rebuilt = 0
+    for phone_number in iter_phone_numbers():
+        try:
+            _refresh_conversation_stats(phone_number)
+            rebuilt += 1
+        except Exception as e:
+            logger.error(f"Error rebuilding stats for {phone_number}: {e}")
+    return rebuilt
+
+def _publish_message_events(phone_number, message_entry):
+    """Tell live dashboards about a saved message and the conversation's new counters"""
+    if not events.has_subscribers():
+        return
+    try:
+        clean_phone = clean_phone_number(phone_number)
+        phone = phone_from_clean(clean_phone)
+        events.publish('message', dict(message_entry, phone=phone))
+        stats = chat_db.fetch_stats([clean_phone]).get(clean_phone)
+        if stats:
+            events.publish('conversation', dict(stats, phone=phone))
+    except Exception as e:
+        logger.error(f"Error publishing message events for {phone_number}: {e}")
+
 def save_message(phone_number, message, direction, message_id=None):
     """
     Save a message to chat history
     direction: 'outgoing' or 'incoming'
+    Returns True once stored, False if storage failed (the error is logged).
     """
     try:
-        ensure_storage_dir()
-        
-        # Load existing history
-        history = load_chat_history(phone_number)
-        
         # Create new message entry
         message_entry = {
             'timestamp': datetime.now().isoformat(),
@@ -51,39 +723,213 @@ def save_message(phone_number, message, direction, message_id=None):
             'message': message,
             'message_id': message_id
         }
-        
-        # Add to history
-        history.append(message_entry)
-        
-        # Save back to file
+
+        if use_sqlite_backend():
+            chat_db.insert_message(clean_phone_number(phone_number), message_entry)
+            logger.info(f"Saved {direction} message for {phone_number}")
+            _publish_message_events(phone_number, message_entry)
+            return True
+
+        ensure_storage_dir()
+
         chat_file = get_chat_file(phone_number)
-        with open(chat_file, 'w', encoding='utf-8') as f:
-            json.dump(history, f, indent=2, ensure_ascii=False)
-        
+
+        with conversation_lock(phone_number):
+            # Bring an older-layout history over before appending so it is not split
+            _adopt_older_chat_file(phone_number, chat_file)
+
+            # Append a single line; earlier messages are never rewritten
+            line = _encode_entries([message_entry])
+            old_signature = _file_signature(chat_file)
+            if old_signature is None:
+                os.makedirs(os.path.dirname(chat_file), exist_ok=True)
+            written = _append_line(chat_file, line)
+            if old_signature is not None:
+                _cache_append(chat_file, old_signature, _file_signature(chat_file), message_entry, written)
+            else:
+                _add_to_phone_index(clean_phone_number(phone_number))
+            _record_conversation_stats(phone_number, message_entry)
+
         logger.info(f"Saved {direction} message for {phone_number}")
-        
+        _publish_message_events(phone_number, message_entry)
+        return True
+
     except Exception as e:
         logger.error(f"Error saving message for {phone_number}: {e}")
+        return False
+
+def migrate_chat_files():
+    """
+    Move every conversation stored in an older layout (flat `.jsonl`, or
+    legacy `.json` arrays) into its shard, then rebuild the phone index.
+    """
+    ensure_storage_dir()
+    migrated = 0
+    for clean_phone, path, kind in list(_iter_chat_files()):
+        if os.path.dirname(path) != CHAT_STORAGE_DIR:
+            continue  # already sharded or cold
+        try:
+            with conversation_lock(clean_phone):
+                chat_file = get_chat_file(clean_phone)
+                if not os.path.exists(path):
+                    continue  # adopted by a concurrent save_message
+                if os.path.exists(chat_file):
+                    logger.warning(f"Skipping {path}: {chat_file} already exists")
+                    continue
+                _adopt_older_chat_file(clean_phone, chat_file)
+            migrated += 1
+            logger.info(f"Migrated {path} to {chat_file}")
+        except Exception as e:
+            logger.error(f"Error migrating {path}: {e}")
+    rebuild_phone_index()
+    return migrated
+
+def _get_cold_after_days():
+    try:
+        return float(os.getenv('CHAT_COLD_AFTER_DAYS', DEFAULT_COLD_AFTER_DAYS))
+    except ValueError:
+        return DEFAULT_COLD_AFTER_DAYS
+
+def dedupe_messages(history):
+    """
+    Drop repeated deliveries of the same message (same message_id and
+    direction), keeping the first. Entries without a real id are kept.
+    """
+    seen = set()
+    unique = []
+    for entry in history:
+        message_id = entry.get('message_id')
+        if message_id not in (None, '', 'unknown'):
+            key = (message_id, entry.get('direction'))
+            if key in seen:
+                continue
+            seen.add(key)
+        unique.append(entry)
+    return unique
+
+def compact_idle_conversations(idle_days=None):
+    """
+    Move hot conversations with no writes for `idle_days` (default
+    CHAT_COLD_AFTER_DAYS) into the gzipped cold tier, deduplicating them on
+    the way. Safe to run while the app is serving; returns a summary dict.
+    """
+    if idle_days is None:
+        idle_days = _get_cold_after_days()
+    cutoff = time.time() - idle_days * 86400
+    summary = {'compacted': 0, 'duplicates_removed': 0, 'bytes_before': 0, 'bytes_after': 0}
+
+    for clean_phone, chat_file, kind in list(_iter_chat_files()):
+        if kind != 'jsonl' or os.path.dirname(os.path.dirname(chat_file)) != CHAT_STORAGE_DIR:
+            continue  # only sharded hot logs; migrate older layouts first
+        try:
+            if os.path.getmtime(chat_file) > cutoff:
+                continue
+            with conversation_lock(clean_phone):
+                # Re-check under the lock: a message may have just arrived
+                if not os.path.exists(chat_file) or os.path.getmtime(chat_file) > cutoff:
+                    continue
+                bytes_before = os.path.getsize(chat_file)
+                history = _read_chat_log(chat_file)
+                unique = dedupe_messages(history)
+
+                cold_file = get_cold_chat_file(clean_phone)
+                os.makedirs(os.path.dirname(cold_file), exist_ok=True)
+                _atomic_write(cold_file, gzip.compress(_encode_entries(unique)))
+                os.remove(chat_file)
+                with _cache_lock:
+                    _cache_discard(chat_file)
+                if len(unique) != len(history):
+                    chat_db.store_stats(clean_phone, *_history_stats(unique))
+
+            bytes_after = os.path.getsize(cold_file)
+            summary['compacted'] += 1
+            summary['duplicates_removed'] += len(history) - len(unique)
+            summary['bytes_before'] += bytes_before
+            summary['bytes_after'] += bytes_after
+            logger.info(f"Compacted {chat_file} -> {cold_file} ({bytes_before} -> {bytes_after} bytes, "
+                        f"{len(history) - len(unique)} duplicates removed)")
+        except Exception as e:
+            logger.error(f"Error compacting {chat_file}: {e}")
+    return summary
+
+def start_compaction_thread(interval_hours=None, idle_days=None):
+    """
+    Run compact_idle_conversations every `interval_hours` (default
+    CHAT_COMPACT_INTERVAL_HOURS) in a daemon thread. Returns the thread.
+    """
+    if interval_hours is None:
+        interval_hours = float(os.getenv('CHAT_COMPACT_INTERVAL_HOURS', '24'))
+
+    def run():
+        while True:
+            time.sleep(interval_hours * 3600)
+            if use_sqlite_backend():
+                continue
+            try:
+                summary = compact_idle_conversations(idle_days)
+                logger.info(f"Chat compaction finished: {summary}")
+            except Exception as e:
+                logger.error(f"Chat compaction failed: {e}")
+
+    thread = threading.Thread(target=run, name='chat-compaction', daemon=True)
+    thread.start()
+    return thread
+
+def import_chat_files_to_sqlite():
+    """
+    Copy every file-backed conversation into the SQLite database. Phones that
+    already have messages there are left alone, so the import can be re-run.
+    """
+    ensure_storage_dir()
+    imported = 0
+    seen = set()
+    for clean_phone, chat_file, kind in sorted(_iter_chat_files()):
+        try:
+            if kind in ('jsonl', 'cold'):
+                history = _read_chat_log(chat_file)
+            else:
+                history = _read_legacy_chat_file(chat_file)
+            if clean_phone in seen:
+                logger.warning(f"Skipping {chat_file}: phone already imported")
+                continue
+            seen.add(clean_phone)
+            if chat_db.has_phone_key(clean_phone):
+                logger.info(f"Skipping {chat_file}: already in the database")
+                continue
+            chat_db.insert_messages(clean_phone, history)
+            imported += 1
+            logger.info(f"Imported {chat_file} ({len(history)} messages)")
+        except Exception as e:
+            logger.error(f"Error importing {chat_file}: {e}")
+    return imported
 
 def get_all_phone_numbers():
     """Get all phone numbers that have chat history"""
     try:
-        ensure_storage_dir()
-        phone_numbers = []
-        
-        for filename in os.listdir(CHAT_STORAGE_DIR):
-            if filename.startswith('chat_') and filename.endswith('.json'):
-                # Extract phone number from filename
-                clean_phone = filename[5:-5]  # Remove 'chat_' and '.json'
-                # Add + back for US numbers
-                if len(clean_phone) == 11 and clean_phone.startswith('1'):
-                    phone_numbers.append(f"+{clean_phone}")
-                elif len(clean_phone) == 10:
-                    phone_numbers.append(f"+1{clean_phone}")
-                else:
-                    phone_numbers.append(f"+{clean_phone}")
-        
-        return phone_numbers
+        return list(iter_phone_numbers())
     except Exception as e:
         logger.error(f"Error getting phone numbers: {e}")
-        return [] 
\ No newline at end of file
+        return []
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Chat history maintenance")
+    parser.add_argument('command', nargs='?', default='migrate', choices=['migrate', 'compact', 'to-sqlite', 'rebuild-stats'],
+                        help="migrate: move older chat files into shards and rebuild the phone index; "
+                             "compact: move idle conversations to the gzipped cold tier; "
+                             "to-sqlite: import file histories into the SQLite database; "
+                             "rebuild-stats: recount the dashboard's per-conversation stats")
+    parser.add_argument('--idle-days', type=float, default=None,
+                        help="compact: idle threshold (default CHAT_COLD_AFTER_DAYS)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'compact':
+        print(f"Compaction summary: {compact_idle_conversations(args.idle_days)}")
+    elif args.command == 'rebuild-stats':
+        print(f"Rebuilt stats for {rebuild_conversation_stats()} conversations")
+    elif args.command == 'to-sqlite':
+        print(f"Imported {import_chat_files_to_sqlite()} conversations into {chat_db.get_db_path()}")
+    else:
+        print(f"Migrated {migrate_chat_files()} chat files into the sharded layout")
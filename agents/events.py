@@ -0,0 +1,104 @@
+"""
+In-process publish/subscribe for live dashboard updates.
+
+`chat_storage.save_message` publishes an event for every saved message and
+the conversation's new counters; `/api/events` streams them to browsers as
+Server-Sent Events. Each subscriber has a bounded queue; one that falls
+behind is dropped and told to resync instead of slowing publishers down.
+Events only reach subscribers in the process that saved the message.
+`subscribe_async` gives asyncio code (the async serving mode) a subscriber
+fed through its event loop, so a stream doesn't hold a thread.
+"""
+import asyncio, itertools, json, logging, queue, threading
+
+logger = logging.getLogger(__name__)
+
+# Events buffered per subscriber before it is considered too slow
+MAX_QUEUED_EVENTS = 256
+
+# Sentinel delivered to a subscriber that was dropped for falling behind
+RESYNC = object()
+
+_subscribers = set()
+_subscribers_lock = threading.Lock()
+_event_ids = itertools.count(1)
+
+def subscribe():
+    """Register a subscriber; returns the queue to read events from"""
+    subscriber = queue.Queue(maxsize=MAX_QUEUED_EVENTS)
+    with _subscribers_lock:
+        _subscribers.add(subscriber)
+    return subscriber
+
+class _LoopSubscriber:
+    """Feeds an asyncio.Queue on its event loop from any publishing thread"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=MAX_QUEUED_EVENTS)
+
+    def put_nowait(self, event):
+        if self.queue.qsize() >= MAX_QUEUED_EVENTS:
+            raise queue.Full
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            unsubscribe(self)
+
+def subscribe_async():
+    """Register a subscriber for the running event loop; read it with next_event_async"""
+    subscriber = _LoopSubscriber(asyncio.get_running_loop())
+    with _subscribers_lock:
+        _subscribers.add(subscriber)
+    return subscriber
+
+def unsubscribe(subscriber):
+    with _subscribers_lock:
+        _subscribers.discard(subscriber)
+
+def has_subscribers():
+    """Lets publishers skip building events nobody will receive"""
+    return bool(_subscribers)
+
+def publish(event_type, data):
+    """Send an event to every subscriber without blocking"""
+    event = {'id': next(_event_ids), 'event': event_type, 'data': data}
+    with _subscribers_lock:
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(event)
+        except queue.Full:
+            unsubscribe(subscriber)
+            logger.warning("Dropped a slow event subscriber")
+        except RuntimeError:
+            unsubscribe(subscriber)  # its event loop has closed
+
+def next_event(subscriber, timeout):
+    """The next event for a subscriber, None on timeout, or RESYNC if it was dropped"""
+    try:
+        return subscriber.get(timeout=timeout)
+    except queue.Empty:
+        with _subscribers_lock:
+            dropped = subscriber not in _subscribers
+        return RESYNC if dropped else None
+
+async def next_event_async(subscriber, timeout):
+    """next_event for a subscriber from subscribe_async"""
+    try:
+        return await asyncio.wait_for(subscriber.queue.get(), timeout)
+    except asyncio.TimeoutError:
+        with _subscribers_lock:
+            dropped = subscriber not in _subscribers
+        return RESYNC if dropped else None
+
+def format_sse(event):
+    """Encode an event in the text/event-stream wire format"""
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'], separators=(',', ':'))}\n\n"
+
+def get_event_stats():
+    with _subscribers_lock:
+        return {'subscribers': len(_subscribers)}
@@ -0,0 +1,123 @@
+"""
+Rule-based fast path for common inbound messages.
+
+Short, formulaic texts ("STOP", "yes", "ok thanks", "what time works?")
+are recognized with a keyword trie over the normalized words plus a few
+compiled patterns, and answered from a template table without calling
+OpenAI. Opt-outs and opt-ins are recorded here. Everything else returns
+None and goes to the LLM.
+"""
+import os, re, logging, threading
+from .opt_outs import record_opt_out, record_opt_in
+
+logger = logging.getLogger(__name__)
+
+# Whole-message phrases, matched word by word after normalization
+KEYWORD_INTENTS = {
+    'opt_out': ['stop', 'stopall', 'unsubscribe', 'cancel', 'end', 'quit', 'stop texting me',
+                'please stop', 'remove me', 'opt out'],
+    'opt_in': ['start', 'unstop', 'resume'],
+    'acknowledge': ['ok', 'okay', 'k', 'kk', 'ok thanks', 'ok thank you', 'okay thanks', 'thanks',
+                    'thank you', 'thanks so much', 'thank you so much', 'thx', 'ty', 'got it',
+                    'got it thanks', 'sounds good', 'sounds good thanks', 'perfect', 'perfect thanks',
+                    'great', 'great thanks', 'cool', 'cool thanks', 'will do'],
+    'affirmative': ['yes', 'yeah', 'yep', 'yup', 'sure', 'absolutely', 'definitely', 'yes please',
+                    'yes i am', 'yes im interested', 'yes i am interested', 'still interested',
+                    'i am interested', 'im interested', 'interested'],
+}
+
+# Patterns checked when the trie does not match the whole message
+PATTERN_INTENTS = [
+    ('schedule', re.compile(
+        r"^(?:so |ok |okay )?(?:what|which) (?:time|times|day|days)(?: and time)? (?:works?|would work|is good|are good)"
+        r"(?: for you)?$|^when (?:are|r) you (?:free|available)$|^when can (?:we|i) (?:meet|see it|come by|tour it)$"
+    )),
+]
+
+REPLY_TEMPLATES = {
+    'opt_out': "You're unsubscribed and won't get more texts from {agent_name}. Reply START to resubscribe.",
+    'opt_in': "You're resubscribed, {first_name}. Reply STOP anytime to opt out.",
+    'acknowledge': "Anytime, {first_name}! Just text me if anything else comes up.",
+    'affirmative': "Great, {first_name}! What day and time work best for you to talk about the {interest}?",
+    'schedule': "I'm pretty flexible this week, {first_name}. Send me a day and time that suit you and I'll lock it in.",
+}
+
+_NON_WORD = re.compile(r"[^a-z0-9\s]+")
+
+_stats = {'messages': 0, 'fast_path': 0, 'by_intent': {}}
+_stats_lock = threading.Lock()
+
+def _build_trie(keyword_intents):
+    trie = {}
+    for intent, phrases in keyword_intents.items():
+        for phrase in phrases:
+            node = trie
+            for word in phrase.split():
+                node = node.setdefault(word, {})
+            node['$'] = intent
+    return trie
+
+_KEYWORD_TRIE = _build_trie(KEYWORD_INTENTS)
+
+def normalize_message(message):
+    """Lowercase, drop apostrophes and punctuation, collapse whitespace"""
+    text = message.lower().replace("'", "").replace("’", "")
+    return ' '.join(_NON_WORD.sub(' ', text).split())
+
+def classify_intent(message):
+    """Intent name for a formulaic message, or None if it needs the LLM"""
+    if not message:
+        return None
+    text = normalize_message(message)
+    if not text:
+        return None
+
+    node = _KEYWORD_TRIE
+    for word in text.split():
+        node = node.get(word)
+        if node is None:
+            break
+    else:
+        if '$' in node:
+            return node['$']
+
+    for intent, pattern in PATTERN_INTENTS:
+        if pattern.match(text):
+            return intent
+    return None
+
+def fast_path_reply(phone_number, message, lead):
+    """
+    Answer a message without the LLM if it is formulaic.
+    Returns (intent, reply text) or None; records opt-outs and opt-ins.
+    """
+    intent = classify_intent(message)
+    with _stats_lock:
+        _stats['messages'] += 1
+        if intent:
+            _stats['fast_path'] += 1
+            _stats['by_intent'][intent] = _stats['by_intent'].get(intent, 0) + 1
+    if intent is None:
+        return None
+
+    if intent == 'opt_out':
+        record_opt_out(phone_number)
+    elif intent == 'opt_in':
+        record_opt_in(phone_number)
+
+    name = (lead.get('name') or '').strip()
+    reply = REPLY_TEMPLATES[intent].format(
+        first_name=name.split()[0] if name else 'there',
+        interest=lead.get('interest') or 'property',
+        agent_name=os.getenv('AGENT_NAME', 'Alex')
+    )
+    logger.info(f"Fast path '{intent}' for {phone_number}")
+    return intent, reply
+
+def get_fast_path_stats():
+    """How many inbound messages were answered without the LLM"""
+    with _stats_lock:
+        stats = {'messages': _stats['messages'], 'fast_path': _stats['fast_path'],
+                 'by_intent': dict(_stats['by_intent'])}
+    stats['fast_path_rate'] = stats['fast_path'] / stats['messages'] if stats['messages'] else 0.0
+    return stats
@@ -1,22 +1,216 @@
 """
 Load leads from `leads.csv` (headers: name,phone,interest).
+
+`iter_leads` streams rows instead of materializing the file, normalizes
+phones to E.164, drops repeated phones and counts malformed rows, so broker
+lists with millions of rows can be imported without holding them in memory.
+`write_leads_snapshot` stores the cleaned leads in SQLite for fast reloads.
 """
-import csv, logging, os
+import csv, logging, os, sqlite3
 logger = logging.getLogger(__name__)
 
-def load_leads_from_csv(csv_path=None):
+LEAD_FIELDS = ('name', 'phone', 'interest')
+
+# How many malformed rows to keep examples of in an import report
+MAX_REPORTED_ROWS = 100
+
+SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leads (
+    position INTEGER NOT NULL,
+    phone TEXT PRIMARY KEY,
+    name TEXT,
+    interest TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_leads_position ON leads (position);
+CREATE TABLE IF NOT EXISTS snapshot_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def get_default_csv_path():
+    # Look for leads.csv in the project root (parent directory)
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(os.path.dirname(current_dir), 'leads.csv')
+
+def normalize_phone(phone):
+    """
+    Normalize a phone to E.164 (+<country><number>). Ten-digit numbers and
+    eleven-digit numbers starting with 1 are treated as US/Canada. Returns
+    None if the value cannot be a phone number.
+    """
+    if not phone:
+        return None
+    phone = phone.strip()
+    digits = ''.join(ch for ch in phone if ch.isdigit())
+    if phone.startswith('00'):
+        digits = digits[2:]  # international dialing prefix
+    elif not phone.startswith('+') and len(digits) == 10:
+        digits = '1' + digits
+    if not 8 <= len(digits) <= 15 or digits.startswith('0'):
+        return None
+    return f"+{digits}"
+
+def new_import_report():
+    """Counters filled in by iter_leads"""
+    return {'rows': 0, 'imported': 0, 'duplicates': 0, 'malformed': 0, 'malformed_rows': []}
+
+def _report_malformed(report, line_number, reason):
+    report['malformed'] += 1
+    if len(report['malformed_rows']) < MAX_REPORTED_ROWS:
+        report['malformed_rows'].append((line_number, reason))
+
+def _iter_rows(f):
+    """
+    Yield (line number, row dict) from a CSV file object. Files without a
+    header row are read positionally as name,phone,interest.
+    """
+    reader = csv.reader(f, skipinitialspace=True)
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = [column.strip().lower() for column in header]
+    if 'phone' in columns:
+        fields = columns
+    else:
+        fields = list(LEAD_FIELDS)
+        yield reader.line_num, dict(zip(fields, header))
+    for values in reader:
+        if not any(value.strip() for value in values):
+            continue
+        yield reader.line_num, dict(zip(fields, values))
+
+def iter_leads(csv_path=None, report=None):
+    """
+    Stream cleaned leads from a CSV file. Each lead is a dict with name,
+    phone (E.164) and interest; the first row for a phone wins. Pass a dict
+    from new_import_report() to collect counts and malformed-row examples.
+    """
     if csv_path is None:
-        # Look for leads.csv in the project root (parent directory)
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        csv_path = os.path.join(os.path.dirname(current_dir), 'leads.csv')
-    
-    leads = []
+        csv_path = get_default_csv_path()
+    if report is None:
+        report = new_import_report()
     if not os.path.exists(csv_path):
         logger.error(f"CSV not found: {csv_path}")
-        return leads
-    with open(csv_path, newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            leads.append({'name': row.get('name'),'phone': row.get('phone'),'interest': row.get('interest')})
+        return
+
+    seen_phones = set()
+    with open(csv_path, newline='', encoding='utf-8-sig') as f:
+        for line_number, row in _iter_rows(f):
+            report['rows'] += 1
+            raw_phone = (row.get('phone') or '').strip()
+            if not raw_phone:
+                _report_malformed(report, line_number, "missing phone")
+                continue
+            phone = normalize_phone(raw_phone)
+            if phone is None:
+                _report_malformed(report, line_number, f"invalid phone {raw_phone!r}")
+                continue
+            if phone in seen_phones:
+                report['duplicates'] += 1
+                continue
+            seen_phones.add(phone)
+            report['imported'] += 1
+            yield {
+                'name': (row.get('name') or '').strip() or 'Potential Client',
+                'phone': phone,
+                'interest': (row.get('interest') or '').strip() or 'Real Estate Inquiry'
+            }
+
+def load_leads_from_csv(csv_path=None):
+    leads = list(iter_leads(csv_path))
     logger.info(f"Loaded {len(leads)} leads")
-    return leads
\ No newline at end of file
+    return leads
+
+def csv_signature(csv_path):
+    """(mtime, size) identifying a version of the CSV, or None if missing"""
+    try:
+        st = os.stat(csv_path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def write_leads_snapshot(csv_path=None, snapshot_path=None, batch_size=10000):
+    """
+    Stream a CSV into a SQLite snapshot (leads keyed by phone) and record
+    which version of the CSV it was built from. Returns the import report.
+    """
+    if csv_path is None:
+        csv_path = get_default_csv_path()
+    if snapshot_path is None:
+        snapshot_path = os.path.splitext(csv_path)[0] + '.db'
+    signature = csv_signature(csv_path)
+    report = new_import_report()
+
+    # Build next to the target and rename, so readers never see a partial snapshot
+    tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript(SNAPSHOT_SCHEMA)
+        batch = []
+        for position, lead in enumerate(iter_leads(csv_path, report)):
+            batch.append((position, lead['phone'], lead['name'], lead['interest']))
+            if len(batch) >= batch_size:
+                conn.executemany("INSERT INTO leads (position, phone, name, interest) VALUES (?, ?, ?, ?)", batch)
+                batch = []
+        if batch:
+            conn.executemany("INSERT INTO leads (position, phone, name, interest) VALUES (?, ?, ?, ?)", batch)
+        conn.executemany("INSERT INTO snapshot_meta (key, value) VALUES (?, ?)", [
+            ('source', os.path.abspath(csv_path)),
+            ('signature', f"{signature[0]}:{signature[1]}" if signature else ''),
+        ])
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, snapshot_path)
+    logger.info(f"Wrote {report['imported']} leads to {snapshot_path} "
+                f"({report['duplicates']} duplicates, {report['malformed']} malformed rows)")
+    return report
+
+def snapshot_is_current(snapshot_path, csv_path=None):
+    """Whether a snapshot was built from the CSV as it is on disk now"""
+    if csv_path is None:
+        csv_path = get_default_csv_path()
+    signature = csv_signature(csv_path)
+    if signature is None or not os.path.exists(snapshot_path):
+        return False
+    try:
+        conn = sqlite3.connect(snapshot_path)
+        try:
+            row = conn.execute("SELECT value FROM snapshot_meta WHERE key = 'signature'").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    return row is not None and row[0] == f"{signature[0]}:{signature[1]}"
+
+def iter_leads_from_snapshot(snapshot_path):
+    """Stream leads from a snapshot in their original CSV order"""
+    conn = sqlite3.connect(snapshot_path)
+    try:
+        for name, phone, interest in conn.execute("SELECT name, phone, interest FROM leads ORDER BY position"):
+            yield {'name': name, 'phone': phone, 'interest': interest}
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Import and validate a leads CSV")
+    parser.add_argument('csv_path', nargs='?', default=None, help="CSV to import (default: leads.csv)")
+    parser.add_argument('--snapshot', default=None, help="Write a SQLite snapshot to this path")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.snapshot:
+        result = write_leads_snapshot(args.csv_path, args.snapshot)
+    else:
+        result = new_import_report()
+        for _ in iter_leads(args.csv_path, result):
+            pass
+    print(f"Rows: {result['rows']}, imported: {result['imported']}, "
+          f"duplicates: {result['duplicates']}, malformed: {result['malformed']}")
+    for line_number, reason in result['malformed_rows']:
+        print(f"  line {line_number}: {reason}")
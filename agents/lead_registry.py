@@ -0,0 +1,122 @@
+"""
+Lead registry keyed by normalized phone.
+
+Parses leads.csv once and re-parses it only when the file's mtime or size
+changes, so webhook lookups and dashboard renders don't re-read the CSV.
+
+With LEADS_SNAPSHOT_PATH set, leads are served from a SQLite snapshot
+(see `lead_collector.write_leads_snapshot`) instead of an in-memory dict,
+for lead lists too large to hold in every worker. The snapshot is rebuilt
+when the CSV changes.
+"""
+import os, logging, sqlite3, threading
+from .lead_collector import (iter_leads, get_default_csv_path, normalize_phone, csv_signature,
+                             write_leads_snapshot, snapshot_is_current, iter_leads_from_snapshot)
+
+logger = logging.getLogger(__name__)
+
+_registry = {'signature': None, 'leads': [], 'by_phone': {}}
+_registry_lock = threading.Lock()
+
+_snapshot_state = {'signature': None}
+_local = threading.local()
+
+def _current_registry(csv_path=None):
+    """Return the registry, reloading it first if leads.csv changed on disk"""
+    if csv_path is None:
+        csv_path = get_default_csv_path()
+    signature = (csv_path, csv_signature(csv_path))
+    with _registry_lock:
+        if signature != _registry['signature']:
+            leads = list(iter_leads(csv_path)) if signature[1] is not None else []
+            by_phone = {lead['phone']: lead for lead in leads}
+            _registry.update(signature=signature, leads=leads, by_phone=by_phone)
+            logger.info(f"Lead registry loaded {len(leads)} leads from {csv_path}")
+        return _registry
+
+def _get_snapshot_path():
+    return os.getenv('LEADS_SNAPSHOT_PATH')
+
+def _ensure_snapshot(snapshot_path, csv_path):
+    """Rebuild the snapshot if the CSV changed since it was written"""
+    signature = (csv_path, csv_signature(csv_path))
+    with _registry_lock:
+        if signature == _snapshot_state['signature']:
+            return
+        if not snapshot_is_current(snapshot_path, csv_path):
+            write_leads_snapshot(csv_path, snapshot_path)
+        _snapshot_state['signature'] = signature
+
+def _snapshot_connection(snapshot_path):
+    """This thread's read connection, reopened when the snapshot file is replaced"""
+    inode = os.stat(snapshot_path).st_ino
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.key == (snapshot_path, inode):
+        return conn
+    if conn is not None:
+        conn.close()
+    conn = sqlite3.connect(snapshot_path)
+    _local.conn = conn
+    _local.key = (snapshot_path, inode)
+    return conn
+
+def find_lead(phone, csv_path=None):
+    """Look up a lead by phone in O(1); returns a copy or None"""
+    key = normalize_phone(phone)
+    if not key:
+        return None
+    if csv_path is None:
+        csv_path = get_default_csv_path()
+
+    snapshot_path = _get_snapshot_path()
+    if snapshot_path and os.path.exists(csv_path):
+        _ensure_snapshot(snapshot_path, csv_path)
+        row = _snapshot_connection(snapshot_path).execute(
+            "SELECT name, phone, interest FROM leads WHERE phone = ?", (key,)
+        ).fetchone()
+        return {'name': row[0], 'phone': row[1], 'interest': row[2]} if row else None
+
+    lead = _current_registry(csv_path)['by_phone'].get(key)
+    return dict(lead) if lead else None
+
+def get_leads(csv_path=None):
+    """All leads in file order, as copies callers may annotate"""
+    if csv_path is None:
+        csv_path = get_default_csv_path()
+
+    snapshot_path = _get_snapshot_path()
+    if snapshot_path and os.path.exists(csv_path):
+        _ensure_snapshot(snapshot_path, csv_path)
+        return list(iter_leads_from_snapshot(snapshot_path))
+
+    return [dict(lead) for lead in _current_registry(csv_path)['leads']]
+
+def count_leads(csv_path=None):
+    """Number of leads, without copying them"""
+    if csv_path is None:
+        csv_path = get_default_csv_path()
+
+    snapshot_path = _get_snapshot_path()
+    if snapshot_path and os.path.exists(csv_path):
+        _ensure_snapshot(snapshot_path, csv_path)
+        # Positions run 0..n-1, so the index answers this without a scan
+        row = _snapshot_connection(snapshot_path).execute("SELECT MAX(position) FROM leads").fetchone()
+        return row[0] + 1 if row[0] is not None else 0
+
+    return len(_current_registry(csv_path)['leads'])
+
+def get_leads_page(offset, limit, csv_path=None):
+    """Up to `limit` leads in file order starting at `offset`, as copies"""
+    if csv_path is None:
+        csv_path = get_default_csv_path()
+
+    snapshot_path = _get_snapshot_path()
+    if snapshot_path and os.path.exists(csv_path):
+        _ensure_snapshot(snapshot_path, csv_path)
+        rows = _snapshot_connection(snapshot_path).execute(
+            "SELECT name, phone, interest FROM leads WHERE position >= ? ORDER BY position LIMIT ?",
+            (offset, limit)
+        )
+        return [{'name': name, 'phone': phone, 'interest': interest} for name, phone, interest in rows]
+
+    return [dict(lead) for lead in _current_registry(csv_path)['leads'][offset:offset + limit]]
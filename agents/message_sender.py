@@ -1,76 +1,289 @@
 """
 Send SMS via Textbelt.
+
+All Textbelt calls share one pooled requests.Session with connect and read
+timeouts, and transient failures are retried with jittered exponential
+backoff. Sends are only retried when Textbelt cannot have accepted the
+message (connection never established, 429/503), so a retry never
+double-texts a lead. TEXTBELT_BASE_URL points the transport at a local
+stub server for testing. `send_sms_async` is the asyncio twin, on a
+pooled httpx.AsyncClient per event loop, for the async serving mode.
+
+Remaining credits are tracked from the `quotaRemaining` field of every send
+response; `get_quota` serves that value and only calls the quota endpoint
+(in the background) once it is older than QUOTA_MAX_AGE seconds.
 """
-import os, logging, requests
+import asyncio, os, logging, random, threading, time, weakref
+import httpx, requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from .chat_storage import save_message
+from .opt_outs import is_opted_out
+from .outbox import mark_sending, mark_sent, mark_failed
 
 logger = logging.getLogger(__name__)
 
-TEXTBELT_API_URL = "https://textbelt.com/text"
+DEFAULT_TEXTBELT_BASE_URL = "https://textbelt.com"
+
+# Statuses where Textbelt rejected the request before processing it
+RETRY_SAFE_STATUSES = {429, 503}
+# Additional statuses worth retrying for read-only calls
+RETRY_IDEMPOTENT_STATUSES = {500, 502, 504}
 
-def send_sms(to, body):
+_session = None
+_session_lock = threading.Lock()
+_async_sessions = weakref.WeakKeyDictionary()  # event loop -> httpx.AsyncClient
+
+_quota = {'remaining': None, 'updated': None, 'checked': None, 'refreshing': False,
+          'from_sends': 0, 'fetches': 0}
+_quota_lock = threading.Lock()
+
+def _env_float(name, default):
     try:
-        # Get API key and webhook URL at runtime (after .env is loaded)
-        api_key = os.getenv('TEXTBELT_API_KEY')
-        webhook_url = os.getenv('TEXTBELT_WEBHOOK_URL')
-        test_mode = os.getenv('TEST_MODE', 'false').lower() == 'true'
-        
-        if not api_key and not test_mode:
-            logger.error("TEXTBELT_API_KEY not found in environment variables")
-            return None
-        
-        logger.debug(f"Using API key: {'SET' if api_key else 'NOT SET'}")
+        return float(os.getenv(name, default))
+    except ValueError:
+        return float(default)
+
+def get_session():
+    """The shared, pooled Textbelt session (created on first use)"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = int(_env_float('TEXTBELT_POOL_SIZE', 10))
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+def textbelt_url(path):
+    base_url = os.getenv('TEXTBELT_BASE_URL', DEFAULT_TEXTBELT_BASE_URL).rstrip('/')
+    return f"{base_url}/{path.lstrip('/')}"
+
+def _never_connected(error):
+    """Whether a requests error happened before the request reached Textbelt"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+def textbelt_post(path, data, idempotent=False):
+    """
+    POST to Textbelt and return the decoded JSON response. Retries up to
+    TEXTBELT_MAX_RETRIES times with full-jitter exponential backoff; calls
+    that are not idempotent are only retried when nothing was processed.
+    """
+    url = textbelt_url(path)
+    timeout = (_env_float('TEXTBELT_CONNECT_TIMEOUT', 5), _env_float('TEXTBELT_READ_TIMEOUT', 15))
+    max_retries = int(_env_float('TEXTBELT_MAX_RETRIES', 3))
+    backoff = _env_float('TEXTBELT_BACKOFF_BASE', 0.5)
+    retry_statuses = RETRY_SAFE_STATUSES | (RETRY_IDEMPOTENT_STATUSES if idempotent else set())
+
+    attempt = 0
+    while True:
+        try:
+            response = get_session().post(url, data=data, timeout=timeout)
+            if response.status_code not in retry_statuses or attempt >= max_retries:
+                return response.json()
+            reason = f"HTTP {response.status_code}"
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt >= max_retries or not (idempotent or _never_connected(e)):
+                raise
+            reason = type(e).__name__
+        delay = random.uniform(0, backoff * (2 ** attempt))
+        attempt += 1
+        logger.warning(f"Textbelt {path} failed ({reason}); retry {attempt}/{max_retries} in {delay:.2f}s")
+        time.sleep(delay)
+
+def _prepare_send(to, body, ignore_opt_out, outbox_key):
+    """
+    Checks shared by send_sms and send_sms_async. Returns ('send', payload)
+    when Textbelt should be called, else ('done', message id or None).
+    """
+    if not ignore_opt_out and is_opted_out(to):
+        logger.info(f"Not sending to {to}: recipient opted out")
+        if outbox_key:
+            mark_failed(outbox_key)
+        return 'done', None
+    
+    # Get API key and webhook URL at runtime (after .env is loaded)
+    api_key = os.getenv('TEXTBELT_API_KEY')
+    webhook_url = os.getenv('TEXTBELT_WEBHOOK_URL')
+    test_mode = os.getenv('TEST_MODE', 'false').lower() == 'true'
+    
+    if not api_key and not test_mode:
+        logger.error("TEXTBELT_API_KEY not found in environment variables")
+        return 'done', None
+    
+    logger.debug(f"Using API key: {'SET' if api_key else 'NOT SET'}")
+    
+    if outbox_key and not mark_sending(outbox_key):
+        logger.info(f"Not sending to {to}: outbox entry already sent or in progress")
+        return 'done', None
+    
+    # Test mode - don't actually send SMS
+    if test_mode:
+        logger.info(f"TEST MODE: Would send to {to}: {body}")
+        test_message_id = f"test_{hash(body) % 10000}"
+        if outbox_key:
+            mark_sent(outbox_key, test_message_id)
         
-        # Test mode - don't actually send SMS
-        if test_mode:
-            logger.info(f"TEST MODE: Would send to {to}: {body}")
-            test_message_id = f"test_{hash(body) % 10000}"
-            
-            # Save outgoing message to chat history
-            save_message(to, body, 'outgoing', test_message_id)
-            
-            return test_message_id
+        # Save outgoing message to chat history
+        save_message(to, body, 'outgoing', test_message_id)
         
-        # Prepare the payload for Textbelt API
-        payload = {
-            'phone': to,
-            'message': body,
-            'key': api_key
-        }
+        return 'done', test_message_id
+    
+    # Prepare the payload for Textbelt API
+    payload = {
+        'phone': to,
+        'message': body,
+        'key': api_key
+    }
+    
+    # Add webhook URL if configured for reply handling
+    if webhook_url:
+        payload['replyWebhookUrl'] = webhook_url
+        logger.debug(f"Including webhook URL: {webhook_url}")
+    
+    logger.debug(f"Sending to Textbelt with payload: {payload}")
+    return 'send', payload
+
+def _finish_send(to, body, response_data, outbox_key):
+    """Record Textbelt's answer to a send; returns the message id or None"""
+    logger.debug(f"Textbelt response: {response_data}")
+    if 'quotaRemaining' in response_data:
+        record_quota(response_data['quotaRemaining'])
+    
+    if response_data.get('success'):
+        message_id = response_data.get('textId', 'unknown')
+        quota_remaining = response_data.get('quotaRemaining', 'unknown')
+        logger.info(f"SMS→{to}, TextID:{message_id}, Quota:{quota_remaining}")
+        if outbox_key:
+            mark_sent(outbox_key, message_id)
         
-        # Add webhook URL if configured for reply handling
-        if webhook_url:
-            payload['replyWebhookUrl'] = webhook_url
-            logger.debug(f"Including webhook URL: {webhook_url}")
+        # Save outgoing message to chat history
+        save_message(to, body, 'outgoing', message_id)
         
-        logger.debug(f"Sending to Textbelt with payload: {payload}")
+        return message_id
+    else:
+        error_message = response_data.get('error', 'Unknown error')
+        logger.error(f"SMS error: {error_message}")
+        if outbox_key:
+            mark_failed(outbox_key)
+        return None
+
+def send_sms(to, body, ignore_opt_out=False, outbox_key=None):
+    """
+    Send one SMS and record it in chat history. Phones that replied STOP are
+    skipped unless ignore_opt_out is set (used for the opt-out confirmation).
+    With an `outbox_key` (see outbox.record_pending) the entry is claimed
+    before dispatch and marked sent as soon as Textbelt accepts it.
+    """
+    try:
+        action, result = _prepare_send(to, body, ignore_opt_out, outbox_key)
+        if action == 'done':
+            return result
         
         # Send SMS via Textbelt API
-        response = requests.post(TEXTBELT_API_URL, data=payload)
-        response_data = response.json()
+        try:
+            response_data = textbelt_post('text', result)
+        except Exception as e:
+            # Only a request that never reached Textbelt is known to be unsent
+            if outbox_key and _never_connected(e):
+                mark_failed(outbox_key)
+            raise
         
-        logger.debug(f"Textbelt response: {response_data}")
-        
-        if response_data.get('success'):
-            message_id = response_data.get('textId', 'unknown')
-            quota_remaining = response_data.get('quotaRemaining', 'unknown')
-            logger.info(f"SMS→{to}, TextID:{message_id}, Quota:{quota_remaining}")
-            
-            # Save outgoing message to chat history
-            save_message(to, body, 'outgoing', message_id)
+        return _finish_send(to, body, response_data, outbox_key)
             
-            return message_id
-        else:
-            error_message = response_data.get('error', 'Unknown error')
-            logger.error(f"SMS error: {error_message}")
-            return None
+    except Exception as e:
+        logger.error("SMS error: " + str(e))
+        return None
+
+def get_async_session():
+    """The running event loop's pooled httpx client for Textbelt"""
+    loop = asyncio.get_running_loop()
+    with _session_lock:
+        client = _async_sessions.get(loop)
+        if client is None:
+            pool_size = int(_env_float('TEXTBELT_POOL_SIZE', 10))
+            limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            client = httpx.AsyncClient(limits=limits)
+            _async_sessions[loop] = client
+        return client
+
+async def close_async_session():
+    """Close the running loop's Textbelt client; call before the loop ends"""
+    with _session_lock:
+        client = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+async def textbelt_post_async(path, data, idempotent=False):
+    """textbelt_post for asyncio code, with the same timeouts and retry rules"""
+    url = textbelt_url(path)
+    timeout = httpx.Timeout(_env_float('TEXTBELT_READ_TIMEOUT', 15), connect=_env_float('TEXTBELT_CONNECT_TIMEOUT', 5))
+    max_retries = int(_env_float('TEXTBELT_MAX_RETRIES', 3))
+    backoff = _env_float('TEXTBELT_BACKOFF_BASE', 0.5)
+    retry_statuses = RETRY_SAFE_STATUSES | (RETRY_IDEMPOTENT_STATUSES if idempotent else set())
+
+    attempt = 0
+    while True:
+        try:
+            response = await get_async_session().post(url, data=data, timeout=timeout)
+            if response.status_code not in retry_statuses or attempt >= max_retries:
+                return response.json()
+            reason = f"HTTP {response.status_code}"
+        except (httpx.TimeoutException, httpx.NetworkError) as e:
+            # ConnectError/ConnectTimeout mean the request never reached Textbelt
+            never_connected = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+            if attempt >= max_retries or not (idempotent or never_connected):
+                raise
+            reason = type(e).__name__
+        delay = random.uniform(0, backoff * (2 ** attempt))
+        attempt += 1
+        logger.warning(f"Textbelt {path} failed ({reason}); retry {attempt}/{max_retries} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+async def send_sms_async(to, body, ignore_opt_out=False, outbox_key=None):
+    """send_sms for asyncio code: the Textbelt call doesn't hold a thread"""
+    try:
+        # Opt-out, outbox and chat history are local file/SQLite work
+        action, result = await asyncio.to_thread(_prepare_send, to, body, ignore_opt_out, outbox_key)
+        if action == 'done':
+            return result
+        
+        try:
+            response_data = await textbelt_post_async('text', result)
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            if outbox_key:
+                await asyncio.to_thread(mark_failed, outbox_key)
+            raise
+        
+        return await asyncio.to_thread(_finish_send, to, body, response_data, outbox_key)
             
     except Exception as e:
         logger.error("SMS error: " + str(e))
         return None
 
-def get_quota():
-    """Check remaining Textbelt quota"""
+def record_quota(remaining, from_send=True):
+    """Remember the remaining credit count reported by Textbelt"""
+    try:
+        remaining = int(remaining)
+    except (TypeError, ValueError):
+        return
+    with _quota_lock:
+        _quota['remaining'] = remaining
+        _quota['updated'] = time.monotonic()
+        if from_send:
+            _quota['from_sends'] += 1
+
+def _fetch_quota():
+    """Ask Textbelt for the remaining quota and record it"""
+    with _quota_lock:
+        _quota['fetches'] += 1
     try:
         api_key = os.getenv('TEXTBELT_API_KEY')
         if not api_key:
@@ -78,14 +291,57 @@ def get_quota():
             return None
             
         payload = {'key': api_key}
-        response = requests.post('https://textbelt.com/quota', data=payload)
-        data = response.json()
+        data = textbelt_post('quota', payload, idempotent=True)
         
         if data.get('success'):
-            return data.get('quotaRemaining', 0)
+            remaining = data.get('quotaRemaining', 0)
+            record_quota(remaining, from_send=False)
+            return remaining
         else:
             logger.error(f"Quota check error: {data.get('error')}")
             return None
     except Exception as e:
         logger.error(f"Quota check error: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def _refresh_quota():
+    try:
+        _fetch_quota()
+    finally:
+        with _quota_lock:
+            _quota['refreshing'] = False
+
+def get_quota(max_age=None):
+    """
+    Remaining Textbelt quota. Returns the last known value; when it is older
+    than `max_age` seconds (QUOTA_MAX_AGE, default 300) a refresh runs in the
+    background. Only blocks when no value is known yet. None if unknown.
+    """
+    if max_age is None:
+        max_age = _env_float('QUOTA_MAX_AGE', 300)
+    now = time.monotonic()
+    with _quota_lock:
+        remaining = _quota['remaining']
+        if _quota['updated'] is not None and now - _quota['updated'] <= max_age:
+            return remaining
+        # Don't retry a failed or in-flight check more than once per max_age
+        if _quota['refreshing'] or (_quota['checked'] is not None and now - _quota['checked'] <= max_age):
+            return remaining
+        _quota['checked'] = now
+        if remaining is not None:
+            _quota['refreshing'] = True
+    if remaining is None:
+        return _fetch_quota()
+    threading.Thread(target=_refresh_quota, name='textbelt-quota', daemon=True).start()
+    return remaining
+
+def get_quota_stats():
+    """Last known quota, its age and how it was learned"""
+    with _quota_lock:
+        updated = _quota['updated']
+        return {
+            'remaining': _quota['remaining'],
+            'age_seconds': None if updated is None else round(time.monotonic() - updated, 1),
+            'from_sends': _quota['from_sends'],
+            'fetches': _quota['fetches']
+        }
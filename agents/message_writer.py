@@ -1,34 +1,283 @@
 """
 Generate follow-ups via OpenAI.
+
+One OpenAI client is shared by the whole process so its HTTP connection
+pool (and TLS sessions) survive between calls. It is created lazily after
+.env is loaded, and rebuilt only if OPENAI_API_KEY or OPENAI_BASE_URL change.
+
+Async callers get an AsyncOpenAI client per event loop (its connection
+pool cannot be shared across loops), configured the same way.
+
+Conversation context is fitted to a token budget (PROMPT_CONTEXT_TOKENS):
+the newest turns are included verbatim, and turns that fall out of the
+budget are folded into a rolling per-conversation summary stored next to
+the chat history. Overflow is kept verbatim until SUMMARY_FOLD_BATCH turns
+have built up, then folded in one summary call on a background thread after
+the reply is generated, so a reply never waits on a summary round-trip and
+prompts stay roughly constant-size however long a conversation runs.
 """
-import os, logging
-from openai import OpenAI
-from .chat_storage import load_chat_history
+import asyncio, os, logging, threading, time, weakref
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from openai import AsyncOpenAI, OpenAI
+from .chat_storage import load_recent_messages, load_summary, save_summary
 
 logger = logging.getLogger(__name__)
 
-def generate_followup(lead, tone_sample):
-    # Initialize OpenAI client at runtime (after .env is loaded)
+_client_lock = threading.Lock()
+_client_state = {'config': None, 'client': None}
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> (config, client)
+_client_stats = {'builds': 0, 'requests': 0, 'connections': 0, 'connect_seconds': 0.0, 'tls_seconds': 0.0}
+_stats_lock = threading.Lock()
+
+# One thread folds summaries in order; phones with a fold in flight are skipped
+_fold_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='summary-fold')
+_folding = set()
+_folding_lock = threading.Lock()
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return float(default)
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return int(default)
+
+def _connection_tracer():
+    """
+    Build an httpcore trace callback that times TCP connect and TLS
+    handshake, which only happen when no pooled connection is available.
+    """
+    started = {}
+
+    def trace(event_name, info):
+        if event_name.endswith('.started'):
+            started[event_name[:-len('.started')]] = time.perf_counter()
+        elif event_name.endswith('.complete'):
+            step = event_name[:-len('.complete')]
+            began = started.pop(step, None)
+            if began is None:
+                return
+            elapsed = time.perf_counter() - began
+            with _stats_lock:
+                if step == 'connection.connect_tcp':
+                    _client_stats['connections'] += 1
+                    _client_stats['connect_seconds'] += elapsed
+                elif step == 'connection.start_tls':
+                    _client_stats['tls_seconds'] += elapsed
+
+    return trace
+
+def _record_connection_timing(request):
+    """httpx request hook attaching the connection tracer"""
+    request.extensions['trace'] = _connection_tracer()
+    with _stats_lock:
+        _client_stats['requests'] += 1
+
+async def _record_connection_timing_async(request):
+    """Async httpx request hook; httpcore awaits trace callbacks in async mode"""
+    trace = _connection_tracer()
+
+    async def async_trace(event_name, info):
+        trace(event_name, info)
+
+    request.extensions['trace'] = async_trace
+    with _stats_lock:
+        _client_stats['requests'] += 1
+
+def _http_client_options():
+    """Pool size, keep-alive and timeouts from the environment"""
+    max_connections = _env_int('OPENAI_MAX_CONNECTIONS', 20)
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=_env_int('OPENAI_MAX_KEEPALIVE', max_connections),
+        keepalive_expiry=_env_float('OPENAI_KEEPALIVE_EXPIRY', 120)
+    )
+    timeout = httpx.Timeout(_env_float('OPENAI_TIMEOUT', 30), connect=_env_float('OPENAI_CONNECT_TIMEOUT', 5))
+    return {'limits': limits, 'timeout': timeout}
+
+def _build_http_client():
+    return httpx.Client(event_hooks={'request': [_record_connection_timing]}, **_http_client_options())
+
+def _client_config():
+    """(api key, base url) the clients are built from, or None without a key"""
     api_key = os.getenv('OPENAI_API_KEY')
     if not api_key:
-        logger.error("OPENAI_API_KEY not found in environment variables")
-        fallback = f"Hi {lead['name']}, just checking in about the {lead['interest']}. Let me know if you have any questions!"
-        logger.info(f"Using fallback message: {fallback}")
-        return fallback
-    
-    client = OpenAI(api_key=api_key)
-    
-    # Get chat history for context
-    chat_history = load_chat_history(lead['phone'])
-    
+        return None
+    return (api_key, os.getenv('OPENAI_BASE_URL') or None)
+
+def get_openai_client():
+    """The shared OpenAI client, or None if OPENAI_API_KEY is not set"""
+    config = _client_config()
+    if config is None:
+        return None
+    with _client_lock:
+        if _client_state['config'] != config:
+            # In-flight calls keep the old client; it is closed when garbage collected
+            _client_state['client'] = OpenAI(api_key=config[0], base_url=config[1], http_client=_build_http_client())
+            _client_state['config'] = config
+            with _stats_lock:
+                _client_stats['builds'] += 1
+            logger.info("Created OpenAI client" + (f" for {config[1]}" if config[1] else ""))
+        return _client_state['client']
+
+def get_async_openai_client():
+    """The running event loop's AsyncOpenAI client, or None without a key"""
+    config = _client_config()
+    if config is None:
+        return None
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        cached = _async_clients.get(loop)
+        if cached is None or cached[0] != config:
+            http_client = httpx.AsyncClient(event_hooks={'request': [_record_connection_timing_async]},
+                                            **_http_client_options())
+            cached = (config, AsyncOpenAI(api_key=config[0], base_url=config[1], http_client=http_client))
+            _async_clients[loop] = cached
+            with _stats_lock:
+                _client_stats['builds'] += 1
+        return cached[1]
+
+async def close_async_openai_client():
+    """Close the running loop's AsyncOpenAI client; call before the loop ends"""
+    with _client_lock:
+        cached = _async_clients.pop(asyncio.get_running_loop(), None)
+    if cached is not None:
+        await cached[1].close()
+
+def get_client_stats():
+    """Request and connection-setup counters for the shared OpenAI client"""
+    with _stats_lock:
+        stats = dict(_client_stats)
+    connections = stats['connections']
+    stats['avg_connect_ms'] = 1000 * stats['connect_seconds'] / connections if connections else 0.0
+    stats['avg_tls_ms'] = 1000 * stats['tls_seconds'] / connections if connections else 0.0
+    return stats
+
+def _fallback_text(lead):
+    return f"Hi {lead['name']}, just checking in about the {lead['interest']}. Let me know if you have any questions!"
+
+def fallback_message(lead):
+    """Canned follow-up used when OpenAI is unavailable"""
+    fallback = _fallback_text(lead)
+    logger.info(f"Using fallback message: {fallback}")
+    return fallback
+
+def is_fallback_message(lead, text):
+    """Whether text is the canned follow-up rather than a generated answer"""
+    return text == _fallback_text(lead)
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) for budgeting prompts"""
+    return len(text) // 4 + 1
+
+def _format_turn(msg):
+    role = "Client" if msg['direction'] == 'incoming' else "Agent"
+    return f"{role}: {msg['message']}\n"
+
+def plan_context(phone):
+    """
+    Decide what conversation context goes into the prompt.
+    Returns (summary record or None, turns to include verbatim, turns to fold
+    into the summary). Only the last CONTEXT_WINDOW_MESSAGES are read.
+    Turns over the budget but not yet summarized stay verbatim; once
+    SUMMARY_FOLD_BATCH of them have built up they are also returned to fold.
+    """
+    budget = _env_int('PROMPT_CONTEXT_TOKENS', 400)
+    window = load_recent_messages(phone, _env_int('CONTEXT_WINDOW_MESSAGES', 20))
+    summary = load_summary(phone)
+
+    # Newest first until the budget is spent; the latest turn always goes in
+    included = []
+    used = 0
+    for msg in reversed(window):
+        cost = estimate_tokens(_format_turn(msg))
+        if included and used + cost > budget:
+            break
+        included.append(msg)
+        used += cost
+    included.reverse()
+
+    older = window[:len(window) - len(included)]
+    through = summary['through'] if summary else ''
+    pending = [msg for msg in older if msg.get('timestamp', '') > through]
+    to_fold = pending if len(pending) >= _env_int('SUMMARY_FOLD_BATCH', 6) else []
+    return summary, pending + included, to_fold
+
+def _summary_prompt(summary, to_fold):
+    prompt = "Update this running summary of an SMS conversation between a real estate agent and a client. "
+    prompt += "Keep names, properties, preferences, questions and commitments; drop small talk. "
+    prompt += "Answer with the updated summary only, under 80 words.\n\n"
+    prompt += f"Current summary:\n{summary['summary'] if summary else '(none)'}\n\n"
+    prompt += "New messages:\n" + ''.join(_format_turn(msg) for msg in to_fold)
+    return prompt
+
+def _summary_kwargs(summary, to_fold):
+    return {
+        'model': os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo'),
+        'messages': [{'role': 'user', 'content': _summary_prompt(summary, to_fold)}],
+        'max_tokens': 150,
+        'temperature': 0.2
+    }
+
+def _store_folded_summary(phone, summary, to_fold, text):
+    """Persist an updated summary; keep the old one if the model returned nothing"""
+    if not text:
+        return summary
+    through = to_fold[-1].get('timestamp', '')
+    save_summary(phone, text, through)
+    logger.info(f"Folded {len(to_fold)} turns into the summary for {phone}")
+    return {'summary': text, 'through': through}
+
+def update_summary(client, phone, summary, to_fold):
+    """Fold turns that left the prompt window into the rolling summary"""
+    if not to_fold:
+        return summary
+    try:
+        response = client.chat.completions.create(**_summary_kwargs(summary, to_fold))
+        return _store_folded_summary(phone, summary, to_fold, _extract_text(response))
+    except Exception as e:
+        logger.error(f"OpenAI summary error: {e}")
+        return summary
+
+def schedule_summary_fold(phone, summary, to_fold):
+    """Fold turns into the summary on a background thread, off the reply path"""
+    if not to_fold:
+        return
+    with _folding_lock:
+        if phone in _folding:
+            return
+        _folding.add(phone)
+
+    def fold():
+        try:
+            client = get_openai_client()
+            if client is not None:
+                update_summary(client, phone, summary, to_fold)
+        finally:
+            with _folding_lock:
+                _folding.discard(phone)
+
+    _fold_executor.submit(fold)
+
+def build_prompt(lead, tone_sample, recent_messages, summary=None):
+    """Prompt for a follow-up given the lead, the latest turns and the rolling summary"""
     # Format chat history for the prompt
     conversation_context = ""
-    if chat_history:
-        # Include up to the last 5 messages for context
-        recent_messages = chat_history[-5:] if len(chat_history) > 5 else chat_history
+    if recent_messages:
         for msg in recent_messages:
-            role = "Client" if msg['direction'] == 'incoming' else "Agent"
-            conversation_context += f"{role}: {msg['message']}\n"
+            conversation_context += _format_turn(msg)
+    
+    # Client messages since the agent last replied
+    unanswered = 0
+    for msg in reversed(recent_messages or []):
+        if msg.get('direction') != 'incoming':
+            break
+        unanswered += 1
     
     # Create a more contextual prompt using the conversation history
     prompt = (
@@ -38,46 +287,85 @@ def generate_followup(lead, tone_sample):
         f"Client interest: {lead['interest']}\n\n"
     )
     
+    if summary and summary.get('summary'):
+        prompt += f"Earlier in the conversation:\n{summary['summary']}\n\n"
+    
     # Add conversation history if available
     if conversation_context:
         prompt += f"Recent conversation:\n{conversation_context}\n"
-        prompt += f"Write a helpful, natural response as the agent that addresses the client's most recent message. "
+        if unanswered > 1:
+            # A burst of texts gets one reply that covers all of them
+            prompt += (f"Write one helpful, natural response as the agent that addresses each of "
+                       f"the client's last {unanswered} messages. ")
+        else:
+            prompt += f"Write a helpful, natural response as the agent that addresses the client's most recent message. "
     else:
         prompt += f"Write a warm, concise follow-up to {lead['name']} about their interest in {lead['interest']}. "
     
     prompt += "Keep it conversational and under 50 words."
     
     logger.debug("Prompt→\n" + prompt)
+    return prompt
+
+def _completion_kwargs(prompt):
+    return {
+        'model': os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo'),
+        'messages': [{'role': 'user', 'content': prompt}],
+        'max_tokens': 150,
+        'temperature': 0.7
+    }
+
+def _extract_text(response):
+    """Safely extract the message content from a chat completion"""
+    if response and hasattr(response, 'choices') and response.choices:
+        if hasattr(response.choices[0], 'message') and response.choices[0].message:
+            if hasattr(response.choices[0].message, 'content'):
+                text = response.choices[0].message.content
+                if text is not None:
+                    return text.strip()
+    return ""
+
+def generate_followup(lead, tone_sample):
+    # Shared client, created at runtime (after .env is loaded)
+    client = get_openai_client()
+    if client is None:
+        logger.error("OPENAI_API_KEY not found in environment variables")
+        return fallback_message(lead)
+    
+    # Fit recent turns to the token budget; older ones are folded into the summary afterwards
+    summary, recent_messages, to_fold = plan_context(lead['phone'])
+    prompt = build_prompt(lead, tone_sample, recent_messages, summary)
     
     try:
-        response = client.chat.completions.create(
-            model=os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo'),
-            messages=[{'role': 'user', 'content': prompt}],
-            max_tokens=150,
-            temperature=0.7
-        )
-        
-        # Safely extract the message content
-        if response and hasattr(response, 'choices') and response.choices:
-            if hasattr(response.choices[0], 'message') and response.choices[0].message:
-                if hasattr(response.choices[0].message, 'content'):
-                    text = response.choices[0].message.content
-                    if text is not None:
-                        text = text.strip()
-                    else:
-                        text = ""
-                else:
-                    text = ""
-            else:
-                text = ""
-        else:
-            text = ""
-            
+        response = client.chat.completions.create(**_completion_kwargs(prompt))
+        text = _extract_text(response)
         logger.info("Generated message: " + text)
         return text
     except Exception as e:
         logger.error(f"OpenAI API error: {e}")
         # Fallback message if OpenAI fails
-        fallback = f"Hi {lead['name']}, just checking in about the {lead['interest']}. Let me know if you have any questions!"
-        logger.info(f"Using fallback message: {fallback}")
-        return fallback
\ No newline at end of file
+        return fallback_message(lead)
+    finally:
+        schedule_summary_fold(lead['phone'], summary, to_fold)
+
+async def generate_followup_async(lead, tone_sample):
+    """Async generate_followup using the event loop's AsyncOpenAI client"""
+    client = get_async_openai_client()
+    if client is None:
+        logger.error("OPENAI_API_KEY not found in environment variables")
+        return fallback_message(lead)
+
+    summary, recent_messages, to_fold = await asyncio.to_thread(plan_context, lead['phone'])
+    prompt = build_prompt(lead, tone_sample, recent_messages, summary)
+
+    try:
+        response = await client.chat.completions.create(**_completion_kwargs(prompt))
+        text = _extract_text(response)
+        logger.info("Generated message: " + text)
+        return text
+    except Exception as e:
+        logger.error(f"OpenAI API error: {e}")
+        return fallback_message(lead)
+    finally:
+        # Folds use the shared sync client on their own thread
+        schedule_summary_fold(lead['phone'], summary, to_fold)
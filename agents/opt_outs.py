@@ -0,0 +1,66 @@
+"""
+Track leads who replied STOP.
+
+Opt-outs and opt-ins are appended to `chat_history/opt_outs.log`
+(timestamp, phone, action per line); the latest action for a phone wins.
+Each process keeps the parsed log in memory and re-reads it only when the
+file changes, so checks before every send are a dict lookup.
+"""
+import os, logging, threading
+from datetime import datetime
+from .chat_storage import CHAT_STORAGE_DIR
+from .lead_collector import normalize_phone
+
+logger = logging.getLogger(__name__)
+
+_state = {'signature': None, 'opted_out': set()}
+_state_lock = threading.Lock()
+
+def get_opt_out_file():
+    return os.path.join(CHAT_STORAGE_DIR, 'opt_outs.log')
+
+def _current_opt_outs():
+    """Set of opted-out phones, re-read if the log changed on disk"""
+    opt_out_file = get_opt_out_file()
+    try:
+        st = os.stat(opt_out_file)
+        signature = (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        signature = None
+    with _state_lock:
+        if signature != _state['signature']:
+            opted_out = set()
+            if signature is not None:
+                with open(opt_out_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        parts = line.rstrip('\n').split('\t')
+                        if len(parts) != 3:
+                            continue
+                        _, phone, action = parts
+                        if action == 'stop':
+                            opted_out.add(phone)
+                        else:
+                            opted_out.discard(phone)
+            _state.update(signature=signature, opted_out=opted_out)
+        return _state['opted_out']
+
+def _record(phone_number, action):
+    phone = normalize_phone(phone_number)
+    if not phone:
+        return
+    os.makedirs(CHAT_STORAGE_DIR, exist_ok=True)
+    with open(get_opt_out_file(), 'a', encoding='utf-8') as f:
+        f.write(f"{datetime.now().isoformat()}\t{phone}\t{action}\n")
+    logger.info(f"Recorded {action} for {phone}")
+
+def record_opt_out(phone_number):
+    """Stop all further messages to a phone"""
+    _record(phone_number, 'stop')
+
+def record_opt_in(phone_number):
+    """Allow messages to a previously opted-out phone again"""
+    _record(phone_number, 'start')
+
+def is_opted_out(phone_number):
+    phone = normalize_phone(phone_number)
+    return bool(phone) and phone in _current_opt_outs()
@@ -0,0 +1,175 @@
+"""
+Durable outbox for outbound SMS.
+
+A message is written here as `pending` before it is handed to Textbelt,
+marked `sending` just before the API call and `sent` (with the Textbelt id)
+as soon as Textbelt accepts it. The idempotency key is derived from phone,
+wave and body, so re-running a wave or retrying a send never texts a lead
+twice for the same message. `recover_pending` resends entries that never
+reached Textbelt after a crash; entries left in `sending` may or may not
+have been delivered and are only resent on request.
+"""
+import os, hashlib, logging, sqlite3, threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTBOX_PATH = os.path.join("chat_history", "outbox.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    key TEXT PRIMARY KEY,
+    phone TEXT NOT NULL,
+    wave_id TEXT,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL,
+    message_id TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status);
+CREATE INDEX IF NOT EXISTS idx_outbox_wave_phone ON outbox (wave_id, phone);
+"""
+
+_local = threading.local()
+
+def get_outbox_path():
+    return os.getenv('OUTBOX_DB_PATH', DEFAULT_OUTBOX_PATH)
+
+def get_connection():
+    """This thread's outbox connection, opened and initialised on first use"""
+    db_path = get_outbox_path()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.path == db_path:
+        return conn
+
+    db_dir = os.path.dirname(db_path)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir, exist_ok=True)
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    _local.conn = conn
+    _local.path = db_path
+    return conn
+
+def outbox_key(phone, wave_id, body):
+    """Idempotency key for one message to one lead in one wave"""
+    raw = '\x1f'.join((phone, wave_id or '', body))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def _now():
+    return datetime.now().isoformat()
+
+def record_pending(phone, body, wave_id=None):
+    """
+    Write a message to the outbox before dispatch. Returns its key, or None
+    if the same message was already sent or is being sent.
+    """
+    key = outbox_key(phone, wave_id, body)
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO outbox (key, phone, wave_id, body, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+            (key, phone, wave_id, body, _now(), _now())
+        )
+        row = conn.execute("SELECT status FROM outbox WHERE key = ?", (key,)).fetchone()
+    if row['status'] in ('sent', 'sending'):
+        logger.info(f"Outbox: message to {phone} already {row['status']}, not sending again")
+        return None
+    return key
+
+def mark_sending(key):
+    """Claim a pending or failed entry for dispatch; False if someone else has it"""
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute(
+            "UPDATE outbox SET status = 'sending', attempts = attempts + 1, updated_at = ? "
+            "WHERE key = ? AND status IN ('pending', 'failed')",
+            (_now(), key)
+        )
+    return cursor.rowcount == 1
+
+def mark_sent(key, message_id):
+    conn = get_connection()
+    with conn:
+        conn.execute("UPDATE outbox SET status = 'sent', message_id = ?, updated_at = ? WHERE key = ?",
+                     (message_id, _now(), key))
+
+def mark_failed(key):
+    """Textbelt rejected the message or it never reached Textbelt"""
+    conn = get_connection()
+    with conn:
+        conn.execute("UPDATE outbox SET status = 'failed', updated_at = ? WHERE key = ?", (_now(), key))
+
+def get_wave_entry(phone, wave_id):
+    """The latest outbox entry for a phone in a wave, or None"""
+    row = get_connection().execute(
+        "SELECT * FROM outbox WHERE wave_id = ? AND phone = ? ORDER BY created_at DESC LIMIT 1",
+        (wave_id, phone)
+    ).fetchone()
+    return dict(row) if row else None
+
+def list_entries(statuses, wave_id=None):
+    """Outbox entries in the given statuses, oldest first"""
+    placeholders = ','.join('?' for _ in statuses)
+    query = f"SELECT * FROM outbox WHERE status IN ({placeholders})"
+    params = list(statuses)
+    if wave_id is not None:
+        query += " AND wave_id = ?"
+        params.append(wave_id)
+    rows = get_connection().execute(query + " ORDER BY created_at", params)
+    return [dict(row) for row in rows]
+
+def recover_pending(wave_id=None, include_unconfirmed=False):
+    """
+    Resend outbox entries that were never acknowledged by Textbelt. Entries
+    stuck in `sending` are skipped unless include_unconfirmed is set, since
+    Textbelt may already have delivered them. Returns the number resent.
+    """
+    from .message_sender import send_sms
+
+    statuses = ['pending', 'sending'] if include_unconfirmed else ['pending']
+    entries = list_entries(statuses, wave_id)
+    if not include_unconfirmed:
+        unconfirmed = len(list_entries(['sending'], wave_id))
+        if unconfirmed:
+            logger.warning(f"Outbox: {unconfirmed} messages may have been sent before a crash; "
+                           f"resend them with include_unconfirmed")
+
+    resent = 0
+    for entry in entries:
+        if entry['status'] == 'sending':
+            # Hand the entry back to send_sms, which claims it again
+            conn = get_connection()
+            with conn:
+                conn.execute("UPDATE outbox SET status = 'pending' WHERE key = ? AND status = 'sending'",
+                             (entry['key'],))
+        logger.info(f"Outbox: resending message to {entry['phone']} (wave {entry['wave_id']})")
+        if send_sms(entry['phone'], entry['body'], outbox_key=entry['key']):
+            resent += 1
+    return resent
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect and recover the SMS outbox")
+    parser.add_argument('command', choices=['list', 'recover'])
+    parser.add_argument('--wave', default=None, help="Only entries from this wave id")
+    parser.add_argument('--include-unconfirmed', action='store_true',
+                        help="Also resend messages interrupted mid-send (may duplicate)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'recover':
+        from dotenv import load_dotenv
+        load_dotenv()
+        print(f"Resent {recover_pending(args.wave, args.include_unconfirmed)} messages")
+    else:
+        for entry in list_entries(['pending', 'sending', 'failed'], args.wave):
+            print(f"{entry['status']:8} {entry['created_at']} {entry['phone']} wave={entry['wave_id']} "
+                  f"attempts={entry['attempts']}: {entry['body'][:60]}")
@@ -0,0 +1,119 @@
+"""
+Background job pool for inbound SMS.
+
+The webhook saves the message and submits a job here so it can acknowledge
+Textbelt in milliseconds; a pool of REPLY_WORKERS threads does the slow work
+(notifying the agent, generating and queueing the reply). Jobs live in
+memory, but the inbound message is already in chat history when the job is
+queued, so a restart loses at most an unanswered reply, never the message.
+
+`submit_debounced` coalesces bursts: items for the same key are collected
+until none has arrived for the debounce window, then one job handles them
+all. Each new item bumps the key's generation, so a job still running for
+an older generation can see it was superseded and discard its result.
+"""
+import os, logging, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+_pool = {'executor': None}
+_pool_lock = threading.Lock()
+_metrics = {'submitted': 0, 'completed': 0, 'failed': 0, 'running': 0,
+            'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0,
+            'run_seconds_total': 0.0, 'run_seconds_max': 0.0}
+_metrics_lock = threading.Lock()
+
+# key -> {'generation': int, 'items': [...], 'timer': Timer}; items stay until a job completes them
+_bursts = {}
+_bursts_lock = threading.Lock()
+_burst_metrics = {'items': 0, 'batches': 0, 'superseded': 0}
+
+def _get_executor():
+    with _pool_lock:
+        if _pool['executor'] is None:
+            try:
+                workers = max(1, int(os.getenv('REPLY_WORKERS', '4')))
+            except ValueError:
+                workers = 4
+            _pool['executor'] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reply-job')
+            logger.info(f"Started {workers} reply workers")
+        return _pool['executor']
+
+def _run(fn, args, submitted_at):
+    started = time.monotonic()
+    with _metrics_lock:
+        waited = started - submitted_at
+        _metrics['running'] += 1
+        _metrics['wait_seconds_total'] += waited
+        _metrics['wait_seconds_max'] = max(_metrics['wait_seconds_max'], waited)
+    outcome = 'completed'
+    try:
+        return fn(*args)
+    except Exception as e:
+        outcome = 'failed'
+        logger.error(f"Reply job {fn.__name__} failed: {e}", exc_info=True)
+    finally:
+        elapsed = time.monotonic() - started
+        with _metrics_lock:
+            _metrics['running'] -= 1
+            _metrics[outcome] += 1
+            _metrics['run_seconds_total'] += elapsed
+            _metrics['run_seconds_max'] = max(_metrics['run_seconds_max'], elapsed)
+
+def submit_job(fn, *args):
+    """Run fn(*args) on the reply pool; returns a Future"""
+    with _metrics_lock:
+        _metrics['submitted'] += 1
+    return _get_executor().submit(_run, fn, args, time.monotonic())
+
+def submit_debounced(key, item, fn, delay):
+    """
+    Add an item to key's burst and (re)start its debounce timer. When the
+    timer fires, fn(key, items, generation) runs on the reply pool with every
+    item not yet completed via complete_burst.
+    """
+    with _bursts_lock:
+        burst = _bursts.setdefault(key, {'generation': 0, 'items': [], 'timer': None})
+        burst['generation'] += 1
+        burst['items'].append(item)
+        if burst['timer'] is not None:
+            burst['timer'].cancel()
+        timer = threading.Timer(delay, submit_job, args=(fn, key, list(burst['items']), burst['generation']))
+        timer.daemon = True
+        burst['timer'] = timer
+        timer.start()
+        _burst_metrics['items'] += 1
+
+def is_current(key, generation):
+    """Whether no newer item arrived for key since this generation"""
+    with _bursts_lock:
+        burst = _bursts.get(key)
+        return burst is not None and burst['generation'] == generation
+
+def complete_burst(key, generation):
+    """
+    Mark a generation's items handled. Returns False (and counts the job as
+    superseded) if a newer item arrived; its job will handle these items too.
+    """
+    with _bursts_lock:
+        burst = _bursts.get(key)
+        if burst is None or burst['generation'] != generation:
+            _burst_metrics['superseded'] += 1
+            return False
+        del _bursts[key]
+        _burst_metrics['batches'] += 1
+        return True
+
+def get_job_stats():
+    """Queue depth and wait/run latency of reply jobs"""
+    with _metrics_lock:
+        stats = dict(_metrics)
+    finished = stats['completed'] + stats['failed']
+    started = finished + stats['running']
+    stats['queued'] = stats['submitted'] - started
+    stats['avg_wait_seconds'] = stats['wait_seconds_total'] / started if started else 0.0
+    stats['avg_run_seconds'] = stats['run_seconds_total'] / finished if finished else 0.0
+    with _bursts_lock:
+        stats['debounce'] = dict(_burst_metrics, open_bursts=len(_bursts))
+    return stats
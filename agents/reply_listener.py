@@ -1,18 +1,32 @@
 """
 Flask webhook for incoming SMS and serve dashboard.
 """
-import os, logging, hmac, hashlib
-from flask import Flask, request, render_template, abort, jsonify
+import os, logging, hmac, hashlib, gzip, json, threading
+from flask import Flask, Response, request, render_template, abort, jsonify
 from .agent_notifier import notify_agent
-from .lead_collector import load_leads_from_csv
-from .chat_storage import save_message, load_chat_history, get_all_phone_numbers
-from .message_writer import generate_followup
-from .message_sender import send_sms
+from .lead_registry import find_lead, get_leads, get_leads_page, count_leads
+from .chat_storage import (save_message, load_chat_page, get_chat_version, clean_phone_number,
+                           get_conversation_stats, recent_conversation_phones, get_cache_stats,
+                           start_compaction_thread)
+from .message_writer import generate_followup, get_client_stats, is_fallback_message
+from .message_sender import get_quota_stats
+from .outbox import record_pending
+from .reply_jobs import submit_job, submit_debounced, is_current, complete_burst, get_job_stats
+from .sms_dispatcher import enqueue_sms, get_dispatch_stats
+from .events import subscribe, unsubscribe, next_event, format_sse, get_event_stats, RESYNC
+from .webhook_dedup import claim_message_id, release_message_id, get_dedup_stats
+from .intent_router import fast_path_reply, classify_intent, get_fast_path_stats
+from .opt_outs import is_opted_out
+from .answer_cache import lookup_answer, remember_answer, purge_answer_cache, get_answer_cache_stats
 
 app = Flask(__name__, static_folder='../static', template_folder='../templates')
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Optional background compaction of idle conversations into the cold tier
+if os.getenv('CHAT_COMPACT_INTERVAL_HOURS'):
+    start_compaction_thread()
+
 def validate_textbelt_webhook(payload, signature):
     """Validate Textbelt webhook signature for security"""
     try:
@@ -41,39 +55,155 @@ def validate_textbelt_webhook(payload, signature):
         logger.error(f"Error in signature validation: {e}")
         return True  # Allow through if validation fails during testing
 
+FALLBACK_AUTO_RESPONSE = "Thanks for your message! I'll get back to you shortly with more information."
+
 def find_lead_by_phone(phone_number):
     """Find lead information by phone number"""
-    leads = load_leads_from_csv()
-    for lead in leads:
-        if lead['phone'] == phone_number:
-            return lead
-    return None
+    return find_lead(phone_number)
+
+def lead_for_number(phone_number):
+    """The lead for a phone number, or a generic entry for unknown numbers"""
+    lead = find_lead_by_phone(phone_number)
+    if not lead:
+        # Create a generic lead entry for unknown numbers
+        lead = {
+            'name': 'Potential Client',
+            'phone': phone_number,
+            'interest': 'Real Estate Inquiry'
+        }
+    return lead
+
+def route_auto_response(from_number, incoming_messages):
+    """
+    Answers that need no LLM call. Returns (lead, (response text or None,
+    intent)) when settled, or (lead, None) when the LLM should write the reply.
+    """
+    # Find the lead information
+    known_lead = find_lead_by_phone(from_number)
+    lead = known_lead or lead_for_number(from_number)
+
+    # An opted-out lead gets no reply at all, unless it is opting back in
+    if is_opted_out(from_number) and not (len(incoming_messages) == 1
+                                          and classify_intent(incoming_messages[0]) == 'opt_in'):
+        logger.info(f"Not replying to {from_number}: opted out")
+        return lead, (None, None)
+
+    # Formulaic messages (STOP, "ok thanks", ...) are answered without the LLM;
+    # a burst that ends in "thanks" may still hold questions, so it goes to the LLM
+    routed = fast_path_reply(from_number, incoming_messages[0], lead) if len(incoming_messages) == 1 else None
+    if routed:
+        intent, response = routed
+        return lead, (response, intent)
+    
+    # Near-duplicate of a question already answered for this listing; unknown
+    # numbers share a placeholder interest, so they never use the cache
+    cached = lookup_answer(incoming_messages[0], lead) if known_lead and len(incoming_messages) == 1 else None
+    if cached:
+        return lead, (cached, 'answer_cache')
+    return lead, None
+
+def get_tone_sample():
+    return os.getenv('AGENT_TONE_SAMPLE', "Thanks for reaching out! Let me help you with that.")
 
-def generate_auto_response(from_number, incoming_message):
-    """Generate an automatic response based on the incoming message"""
+def generate_auto_response(from_number, incoming_messages):
+    """
+    Generate one automatic response to a burst of incoming messages (oldest
+    first). Returns (response text or None, fast-path intent, 'fallback'
+    for the canned error reply, or None for a generated answer).
+    """
     try:
-        # Find the lead information
-        lead = find_lead_by_phone(from_number)
-        
-        if not lead:
-            # Create a generic lead entry for unknown numbers
-            lead = {
-                'name': 'Potential Client',
-                'phone': from_number,
-                'interest': 'Real Estate Inquiry'
-            }
-        
-        # Use the incoming message context to generate a relevant response
-        tone_sample = os.getenv('AGENT_TONE_SAMPLE', "Thanks for reaching out! Let me help you with that.")
+        lead, routed = route_auto_response(from_number, incoming_messages)
+        if routed:
+            return routed
         
         # Generate contextual response based on chat history
-        response = generate_followup(lead, tone_sample)
-        return response
+        response = generate_followup(lead, get_tone_sample())
+        return response, None
         
     except Exception as e:
         logger.error(f"Error generating auto-response: {e}")
-        # Fallback response
-        return "Thanks for your message! I'll get back to you shortly with more information."
+        # Fallback response; the intent keeps it out of the answer cache
+        return FALLBACK_AUTO_RESPONSE, 'fallback'
+
+def record_auto_response(response_id, from_number, message_text, auto_response, intent):
+    """Log a reply's outcome and remember a generated answer that went out"""
+    if not response_id:
+        logger.error("❌ Failed to send auto-response")
+        return
+    logger.info(f"✅ Auto-response sent successfully! ID: {response_id}")
+    if intent is None and message_text:
+        # A generated answer that went out can serve similar questions from known leads
+        lead = find_lead_by_phone(from_number)
+        if lead and not is_fallback_message(lead, auto_response):
+            remember_answer(message_text, lead, auto_response)
+
+def auto_response_sent(future, from_number, message_text, auto_response, intent):
+    """Runs on the dispatcher worker once a queued auto-response was attempted"""
+    try:
+        response_id = future.result()
+    except Exception as e:
+        logger.error(f"❌ Failed to send auto-response: {e}")
+        return
+    record_auto_response(response_id, from_number, message_text, auto_response, intent)
+
+def claim_auto_response(from_number, auto_response, message_id):
+    """
+    Outbox entry for a reply, keyed by the inbound message so a redelivered
+    webhook isn't answered twice. Returns (send?, outbox key or None).
+    """
+    if not message_id or message_id == 'unknown':
+        return True, None
+    outbox_key = record_pending(from_number, auto_response, f"reply:{message_id}")
+    return outbox_key is not None, outbox_key
+
+def webhook_fields(data, is_json):
+    """(from number, text, messageId) from a Textbelt JSON body or a legacy form post"""
+    if is_json:
+        # Textbelt webhook format
+        return data.get('fromNumber'), data.get('text'), data.get('messageId')
+    # Fallback to form data for backward compatibility
+    return (data.get('fromNumber', data.get('From', data.get('from'))),
+            data.get('text', data.get('Body')),
+            data.get('messageId', 'unknown'))
+
+def debounce_seconds():
+    try:
+        return max(0.0, float(os.getenv('REPLY_DEBOUNCE_SECONDS', '8')))
+    except ValueError:
+        return 8.0
+
+def process_inbound_messages(from_number, messages, generation=None):
+    """
+    Reply job for a burst of (text, message_id) from one phone: generate a
+    single auto-response, notify the agent, then queue the reply. With a
+    debounce `generation`, the job is dropped if a newer message arrived
+    meanwhile; the newer job notifies the agent of the whole burst, once.
+    """
+    texts = [text for text, _ in messages]
+    message_id = messages[-1][1]
+    
+    if generation is not None and not is_current(from_number, generation):
+        logger.info(f"Skipping reply to {from_number}: more messages arrived")
+        return
+    logger.info(f"🤖 Generating automatic response to {len(texts)} message(s)...")
+    auto_response, intent = generate_auto_response(from_number, texts)
+    if generation is not None and not complete_burst(from_number, generation):
+        # The newer burst includes these messages and gets one reply for all of them
+        logger.info(f"Discarding reply to {from_number}: superseded by newer messages")
+        return
+    notify_agent(from_number, "\n".join(texts))
+    if not auto_response:
+        return
+    
+    logger.info(f"📤 Queueing auto-response: {auto_response[:50]}...")
+    should_send, outbox_key = claim_auto_response(from_number, auto_response, message_id)
+    if not should_send:
+        return
+    # Only a single question is worth remembering as a reusable answer
+    question = texts[0] if len(texts) == 1 else None
+    # The STOP confirmation is the one message an opted-out lead still gets
+    future = enqueue_sms(from_number, auto_response, ignore_opt_out=(intent == 'opt_out'), outbox_key=outbox_key)
+    future.add_done_callback(lambda f: auto_response_sent(f, from_number, question, auto_response, intent))
 
 @app.route('/sms', methods=['POST'])
 def sms_reply():
@@ -101,75 +231,179 @@ def sms_reply():
             data = request.get_json()
             logger.debug(f"JSON data: {data}")
             
-            # Textbelt webhook format
-            from_number = data.get('fromNumber')
-            message_text = data.get('text')
-            message_id = data.get('messageId')
+            from_number, message_text, message_id = webhook_fields(data, True)
             
             logger.info(f"📱 Textbelt webhook - MessageID: {message_id}, From: {from_number}")
             
         else:
             logger.info("📋 Processing form data")
-            # Fallback to form data for backward compatibility
-            from_number = request.form.get('fromNumber', request.form.get('From', request.form.get('from')))
-            message_text = request.form.get('text', request.form.get('Body'))
-            message_id = request.form.get('messageId', 'unknown')
+            from_number, message_text, message_id = webhook_fields(request.form, False)
             logger.debug(f"Form data - From: {from_number}, Text: {message_text}")
         
-        if from_number and message_text:
-            logger.info(f"💬 SMS Reply from {from_number}: {message_text}")
-            
-            # Save incoming message to chat history
-            save_message(from_number, message_text, 'incoming', message_id)
-            
-            # Notify agent about the message
-            notify_agent(from_number, message_text)
-            
-            # Generate and send automatic response
-            logger.info("🤖 Generating automatic response...")
-            auto_response = generate_auto_response(from_number, message_text)
-            
-            if auto_response:
-                logger.info(f"📤 Sending auto-response: {auto_response[:50]}...")
-                response_id = send_sms(from_number, auto_response)
-                
-                if response_id:
-                    logger.info(f"✅ Auto-response sent successfully! ID: {response_id}")
-                else:
-                    logger.error("❌ Failed to send auto-response")
-            
-            # Return success response as expected by Textbelt
-            return {'success': True, 'message': 'Message received and auto-response sent'}, 200
-        else:
+        if not (from_number and message_text):
             logger.warning(f"⚠️ Incomplete webhook data - from: {from_number}, text: {message_text}")
             return {'error': 'Missing required fields'}, 400
         
+        # Textbelt retries webhooks; a messageId we already handled costs nothing
+        if not claim_message_id(message_id):
+            logger.info(f"Ignoring duplicate webhook for message {message_id}")
+            return {'success': True, 'message': 'Duplicate message ignored'}, 200
+        
+        logger.info(f"💬 SMS Reply from {from_number}: {message_text}")
+        
+        # Save incoming message to chat history
+        if not save_message(from_number, message_text, 'incoming', message_id):
+            # Nothing was stored, so let Textbelt's retry through
+            release_message_id(message_id)
+            return {'error': 'Could not store message'}, 500
+        
+        # Reply in the background so Textbelt gets its 200 right away. Texts sent
+        # in quick succession are answered together; STOP/START never wait.
+        debounce = debounce_seconds()
+        if debounce and classify_intent(message_text) not in ('opt_out', 'opt_in'):
+            submit_debounced(from_number, (message_text, message_id), process_inbound_messages, debounce)
+        else:
+            submit_job(process_inbound_messages, from_number, [(message_text, message_id)])
+        
+        # Return success response as expected by Textbelt
+        return {'success': True, 'message': 'Message received'}, 200
+        
     except Exception as e:
         logger.error(f"❌ Error processing Textbelt webhook: {e}", exc_info=True)
         return {'error': 'Internal server error'}, 500
 
+def _json_response(payload, etag=None):
+    """JSON response with an optional ETag, gzipped when large and the client accepts it"""
+    body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    headers = {'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+    if etag:
+        headers['ETag'] = etag
+    min_gzip_bytes = int(os.getenv('API_GZIP_MIN_BYTES', '1024'))
+    if len(body) >= min_gzip_bytes and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        body = gzip.compress(body, compresslevel=5)
+        headers['Content-Encoding'] = 'gzip'
+    return app.response_class(body, mimetype='application/json', headers=headers)
+
 @app.route('/api/chat/<phone_number>')
 def get_chat_history(phone_number):
-    """API endpoint to get chat history for a phone number"""
+    """
+    Chat history for a phone number. Optional query parameters: `limit`,
+    and a timestamp cursor, `before` (older page) or `since` (new messages).
+    Answers 304 when the client's ETag is still current.
+    """
     try:
         # Ensure phone number has + prefix
         if not phone_number.startswith('+'):
             phone_number = '+' + phone_number
-            
-        history = load_chat_history(phone_number)
-        return jsonify({
+        
+        limit = request.args.get('limit', type=int)
+        if limit is not None and limit < 0:
+            return jsonify({'error': 'limit must not be negative'}), 400
+        before = request.args.get('before')
+        since = request.args.get('since')
+        
+        # The conversation's version plus the query identifies this exact response
+        version = get_chat_version(phone_number) or 'empty'
+        digest = hashlib.sha1(f"{version}|{limit}|{before}|{since}".encode('utf-8')).hexdigest()
+        etag = f'"{digest}"'
+        if request.headers.get('If-None-Match') == etag:
+            return '', 304, {'ETag': etag, 'Cache-Control': 'no-cache'}
+        
+        messages, has_more = load_chat_page(phone_number, limit, before, since)
+        return _json_response({
             'phone_number': phone_number,
-            'messages': history
-        })
+            'messages': messages,
+            'has_more': has_more
+        }, etag)
     except Exception as e:
         logger.error(f"Error getting chat history for {phone_number}: {e}")
         return jsonify({'error': 'Failed to load chat history'}), 500
 
+# Each open /api/events stream holds a server thread; the cap keeps some for /sms
+_sse_streams = {'open': 0, 'rejected': 0}
+_sse_streams_lock = threading.Lock()
+
+def _release_sse_stream():
+    with _sse_streams_lock:
+        _sse_streams['open'] -= 1
+
+def get_sse_stream_stats():
+    """Open and refused /api/events streams in this worker"""
+    with _sse_streams_lock:
+        stats = dict(_sse_streams)
+    stats['max'] = int(os.getenv('SSE_MAX_STREAMS', '4'))
+    return stats
+
+@app.route('/api/events')
+def event_stream():
+    """Server-Sent Events feed of saved messages and conversation counters"""
+    keepalive = float(os.getenv('SSE_KEEPALIVE_SECONDS', '15'))
+    retry_seconds = int(os.getenv('SSE_RETRY_SECONDS', '30'))
+    
+    with _sse_streams_lock:
+        if _sse_streams['open'] >= int(os.getenv('SSE_MAX_STREAMS', '4')):
+            _sse_streams['rejected'] += 1
+            full = True
+        else:
+            _sse_streams['open'] += 1
+            full = False
+    if full:
+        # Every stream slot is taken; the dashboard tries again later
+        return Response(f"retry: {retry_seconds * 1000}\n\n", status=503, mimetype='text/event-stream',
+                        headers={'Retry-After': str(retry_seconds), 'Cache-Control': 'no-cache'})
+    
+    def stream():
+        subscriber = subscribe()
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                event = next_event(subscriber, keepalive)
+                if event is None:
+                    # Comment line keeps proxies from closing an idle stream
+                    yield ": keepalive\n\n"
+                elif event is RESYNC:
+                    # Fell too far behind; the browser reconnects and reloads its view
+                    yield "event: resync\ndata: {}\n\n"
+                    return
+                else:
+                    yield format_sse(event)
+        finally:
+            unsubscribe(subscriber)
+    
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Runs when the server closes the response, even if the stream never started
+    response.call_on_close(_release_sse_stream)
+    return response
+
 @app.route('/webhook/health', methods=['GET'])
 def webhook_health():
     """Health check endpoint for webhook"""
     return {'status': 'healthy', 'service': 'textbelt-webhook', 'mode': 'auto-responder'}, 200
 
+@app.route('/api/stats', methods=['GET'])
+def service_stats():
+    """Runtime counters for this worker process"""
+    return jsonify({
+        'chat_cache': get_cache_stats(),
+        'openai_client': get_client_stats(),
+        'fast_path': get_fast_path_stats(),
+        'answer_cache': get_answer_cache_stats(),
+        'webhook_dedup': get_dedup_stats(),
+        'live_events': get_event_stats(),
+        'sse_streams': get_sse_stream_stats(),
+        'reply_jobs': get_job_stats(),
+        'sms_queue': get_dispatch_stats(),
+        'textbelt_quota': get_quota_stats()
+    })
+
+@app.route('/api/answer-cache/purge', methods=['POST'])
+def purge_cached_answers():
+    """Drop cached answers after listing details change; optional JSON {"scope": interest}"""
+    data = request.get_json(silent=True) or {}
+    removed = purge_answer_cache(data.get('scope'))
+    return {'success': True, 'removed': removed}, 200
+
 @app.route('/api/send-test', methods=['POST'])
 def send_test_message():
     """Manual endpoint to send a test message (for testing purposes)"""
@@ -181,7 +415,7 @@ def send_test_message():
         if not phone or not message:
             return {'error': 'Phone and message required'}, 400
         
-        message_id = send_sms(phone, message)
+        message_id = enqueue_sms(phone, message).result()
         if message_id:
             return {'success': True, 'message_id': message_id}, 200
         else:
@@ -191,28 +425,48 @@ def send_test_message():
         logger.error(f"Error sending test message: {e}")
         return {'error': 'Internal server error'}, 500
 
+DASHBOARD_SORTS = ('file', 'name', 'recent')
+
 @app.route('/')
 def dashboard():
-    leads = load_leads_from_csv()
+    """Lead status table, one page at a time, from the materialized conversation stats"""
+    sort = request.args.get('sort', 'file')
+    if sort not in DASHBOARD_SORTS:
+        sort = 'file'
+    page_size = max(1, int(os.getenv('DASHBOARD_PAGE_SIZE', '50')))
     
-    # Get chat history for each lead to show message count
-    chat_phones = get_all_phone_numbers()
+    if sort == 'file':
+        # File order pages straight from the registry, copying only this page
+        pages = max(1, -(-count_leads() // page_size))
+        page = min(max(1, request.args.get('page', 1, type=int)), pages)
+        leads = get_leads_page((page - 1) * page_size, page_size)
+    else:
+        leads = get_leads()
+        if sort == 'name':
+            leads.sort(key=lambda lead: lead['name'].lower())
+        else:
+            # Leads without a conversation keep file order after the active ones
+            rank = {clean_phone_number(phone): i for i, phone in enumerate(recent_conversation_phones())}
+            leads.sort(key=lambda lead: rank.get(clean_phone_number(lead['phone']), len(rank)))
+        pages = max(1, -(-len(leads) // page_size))
+        page = min(max(1, request.args.get('page', 1, type=int)), pages)
+        leads = leads[(page - 1) * page_size:page * page_size]
     
+    stats = get_conversation_stats([lead['phone'] for lead in leads])
     for lead in leads:
         lead['status'] = 'Ready to Respond'
-        # Count messages if chat history exists
-        if lead['phone'] in chat_phones:
-            history = load_chat_history(lead['phone'])
-            incoming_count = len([msg for msg in history if msg['direction'] == 'incoming'])
-            outgoing_count = len([msg for msg in history if msg['direction'] == 'outgoing'])
-            lead['message_count'] = f"{outgoing_count} sent, {incoming_count} received"
-            if incoming_count > 0:
+        lead['last_activity'] = ''
+        counts = stats.get(lead['phone'])
+        if counts:
+            lead['message_count'] = f"{counts['outgoing']} sent, {counts['incoming']} received"
+            lead['last_activity'] = (counts['last_activity'] or '')[:16].replace('T', ' ')
+            if counts['incoming'] > 0:
                 lead['status'] = 'Active Conversation'
         else:
             lead['message_count'] = "No messages yet"
     
     demo = os.getenv('DEMO_VIDEO_URL', '')
-    return render_template('index.html', leads=leads, demo_video=demo)
+    return render_template('index.html', leads=leads, demo_video=demo, page=page, pages=pages, sort=sort)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.getenv('PORT',8080)))
\ No newline at end of file
@@ -1,18 +1,154 @@
 """
 Send a wave of follow-ups.
+
+The wave is a pipeline: up to WAVE_CONCURRENCY drafts are generated at once
+with the async OpenAI client, finished drafts wait in a bounded queue, and a
+single sender hands them to the SMS dispatcher no faster than one per `delay`
+seconds. LLM time overlaps the send spacing, so a wave takes about
+len(leads) * delay.
+
+The wave also keeps WAVE_QUOTA_RESERVE Textbelt credits back for replies:
+drafts are only started while the remaining quota covers them, and the wave
+stops once the quota is down to the reserve.
+
+Every message goes through the outbox under the wave's id (WAVE_ID, default
+today's date). Re-running a wave skips leads it already texted and resends
+the stored draft, rather than a new one, to leads whose send was cut short.
 """
-import time, logging
-from .lead_collector import load_leads_from_csv
-from .message_writer import generate_followup
-from .message_sender import send_sms
+import asyncio, os, time, logging
+from datetime import date
+from .lead_collector import iter_leads
+from .message_writer import generate_followup_async, close_async_openai_client
+from .message_sender import get_quota
+from .sms_dispatcher import enqueue_sms
+from .opt_outs import is_opted_out
+from .outbox import record_pending, get_wave_entry
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def send_wave(tone_sample, delay=60):
-    leads = load_leads_from_csv()
-    for lead in leads:
-        logger.info("Processing lead: " + str(lead))
-        msg = generate_followup(lead, tone_sample)
-        send_sms(lead['phone'], msg)
-        time.sleep(delay)
\ No newline at end of file
+def _wave_concurrency():
+    try:
+        return max(1, int(os.getenv('WAVE_CONCURRENCY', '5')))
+    except ValueError:
+        return 5
+
+def _quota_reserve():
+    try:
+        return max(0, int(os.getenv('WAVE_QUOTA_RESERVE', '10')))
+    except ValueError:
+        return 10
+
+def _quota_budget(reserve):
+    """Credits the wave may still spend, or None if the quota is unknown"""
+    remaining = get_quota()
+    return None if remaining is None else remaining - reserve
+
+async def send_wave_async(tone_sample, delay=60, concurrency=None, lookahead=None, wave_id=None):
+    """
+    Generate and send a follow-up to every lead. `concurrency` bounds
+    in-flight generations; `lookahead` bounds drafts waiting to be sent
+    (default 2 * concurrency). Returns the number of messages sent.
+    """
+    if wave_id is None:
+        wave_id = os.getenv('WAVE_ID') or date.today().isoformat()
+    if concurrency is None:
+        concurrency = _wave_concurrency()
+    if lookahead is None:
+        lookahead = 2 * concurrency
+
+    reserve = _quota_reserve()
+    budget = await asyncio.to_thread(_quota_budget, reserve)
+    if budget is not None and budget <= 0:
+        logger.warning(f"Not starting wave: Textbelt quota is at the reserve of {reserve}")
+        return 0
+
+    drafts = asyncio.Queue(maxsize=lookahead)
+    slots = asyncio.Semaphore(concurrency)
+    done = object()
+    # Drafts started but not yet sent or dropped, and a wakeup when that drops
+    pending = {'count': 0}
+    progress = asyncio.Event()
+
+    def settle():
+        pending['count'] -= 1
+        progress.set()
+
+    async def draft(lead, stored=None):
+        queued = False
+        try:
+            logger.info("Processing lead: " + str(lead))
+            msg = stored if stored is not None else await generate_followup_async(lead, tone_sample)
+            # Holding the slot until the draft is queued applies backpressure
+            await drafts.put((lead, msg))
+            queued = True
+        finally:
+            slots.release()
+            if not queued:
+                settle()
+
+    async def has_budget():
+        """Wait until the quota covers one more draft; False once it never will"""
+        while True:
+            budget = _quota_budget(reserve)
+            if budget is None or pending['count'] < budget:
+                return True
+            if budget <= 0:
+                return False
+            # Low on credits: don't draft more than the quota can send
+            progress.clear()
+            await progress.wait()
+
+    async def produce():
+        tasks = []
+        for lead in iter_leads():
+            if is_opted_out(lead['phone']):
+                logger.info(f"Skipping {lead['phone']}: opted out")
+                continue
+            entry = get_wave_entry(lead['phone'], wave_id)
+            if entry and entry['status'] in ('sent', 'sending'):
+                logger.info(f"Skipping {lead['phone']}: already texted in wave {wave_id}")
+                continue
+            if not await has_budget():
+                logger.warning(f"Stopping wave: Textbelt quota is at the reserve of {reserve}")
+                break
+            await slots.acquire()
+            pending['count'] += 1
+            tasks.append(asyncio.create_task(draft(lead, entry['body'] if entry else None)))
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await drafts.put(done)
+
+    async def send():
+        sent = 0
+        next_send = time.monotonic()
+        while True:
+            item = await drafts.get()
+            if item is done:
+                return sent
+            lead, msg = item
+            budget = _quota_budget(reserve)
+            if budget is not None and budget <= 0:
+                logger.warning(f"Dropping draft for {lead['phone']}: Textbelt quota is at the reserve")
+                settle()
+                continue
+            wait = next_send - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            key = record_pending(lead['phone'], msg, wave_id)
+            if key and await asyncio.wrap_future(enqueue_sms(lead['phone'], msg, outbox_key=key)):
+                sent += 1
+            settle()
+            next_send = time.monotonic() + delay
+
+    producer = asyncio.create_task(produce())
+    try:
+        sent = await send()
+        await producer
+    finally:
+        producer.cancel()
+        await close_async_openai_client()
+    logger.info(f"Wave {wave_id} complete: {sent} messages sent")
+    return sent
+
+def send_wave(tone_sample, delay=60, wave_id=None):
+    return asyncio.run(send_wave_async(tone_sample, delay, wave_id=wave_id))
@@ -0,0 +1,238 @@
+"""
+Outbound SMS queue drained by a rate-limited worker pool.
+
+Callers enqueue with `enqueue_sms` and get a Future for the Textbelt
+message id instead of calling Textbelt in their own thread. Each
+destination always maps to the same worker, so messages to one lead go out
+in order. Sends are paced by a global token bucket (SMS_GLOBAL_RATE per
+second) and a per-number bucket (SMS_PER_NUMBER_RATE per second). A number
+waiting on its own bucket is set aside by its worker, which keeps sending
+to other numbers meanwhile; idle per-number buckets are dropped once full.
+`dispatch_sms_async` applies the same buckets to asyncio callers, sleeping
+on the event loop instead of in a worker thread.
+"""
+import asyncio, heapq, itertools, os, logging, queue, threading, time, zlib
+from collections import deque
+from concurrent.futures import Future
+from .lead_collector import normalize_phone
+from .message_sender import send_sms, send_sms_async
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Thread-safe token bucket; reserve() returns how long to wait for a token"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token (possibly going into debt) and return the wait in seconds"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self, now):
+        """Whether the bucket has refilled, so dropping it changes nothing"""
+        with self.lock:
+            return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+_state = {'queues': None, 'workers': [], 'global_bucket': None, 'number_buckets': {}, 'sweep_at': 256, 'held': 0}
+_state_lock = threading.Lock()
+_metrics = {'enqueued': 0, 'sent': 0, 'failed': 0, 'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0, 'rate_limited_seconds_total': 0.0}
+_metrics_lock = threading.Lock()
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return float(default)
+
+def _sweep_number_buckets():
+    """Drop full per-number buckets; caller holds _state_lock"""
+    now = time.monotonic()
+    buckets = _state['number_buckets']
+    for phone in [phone for phone, bucket in buckets.items() if bucket.is_full(now)]:
+        del buckets[phone]
+    # Sweep again once the map has doubled, so the cost stays amortised
+    _state['sweep_at'] = max(256, 2 * len(buckets))
+
+def _reserve_number_token(phone):
+    """Take a token from the number's bucket and return the wait in seconds"""
+    with _state_lock:
+        buckets = _state['number_buckets']
+        bucket = buckets.get(phone)
+        if bucket is None:
+            if len(buckets) >= _state['sweep_at']:
+                _sweep_number_buckets()
+            rate = _env_float('SMS_PER_NUMBER_RATE', 0.2)
+            bucket = TokenBucket(rate, max(1.0, _env_float('SMS_PER_NUMBER_BURST', 1)))
+            buckets[phone] = bucket
+        # Reserved under the lock so a sweep cannot drop the bucket in between
+        return bucket.reserve()
+
+def _ensure_global_bucket():
+    with _state_lock:
+        if _state['global_bucket'] is None:
+            global_rate = _env_float('SMS_GLOBAL_RATE', 1)
+            _state['global_bucket'] = TokenBucket(global_rate, max(1.0, _env_float('SMS_GLOBAL_BURST', global_rate)))
+        return _state['global_bucket']
+
+def _record_dispatch(waited, throttled):
+    with _metrics_lock:
+        _metrics['wait_seconds_total'] += waited
+        _metrics['wait_seconds_max'] = max(_metrics['wait_seconds_max'], waited)
+        _metrics['rate_limited_seconds_total'] += throttled
+
+def _hold(delta):
+    with _metrics_lock:
+        _state['held'] += delta
+
+def _send_job(job, throttled):
+    to, body, send_kwargs, future, enqueued_at = job
+    throttled += _ensure_global_bucket().acquire()
+    _record_dispatch(time.monotonic() - enqueued_at, throttled)
+    try:
+        message_id = send_sms(to, body, **send_kwargs)
+    except Exception as e:  # send_sms logs its own errors; never kill a worker
+        future.set_exception(e)
+        message_id = None
+    else:
+        future.set_result(message_id)
+    with _metrics_lock:
+        _metrics['sent' if message_id else 'failed'] += 1
+
+def _worker(jobs):
+    """
+    Send jobs from one queue. Jobs are held per number, and a number whose
+    bucket is empty is scheduled for later rather than slept on, so it does
+    not hold up the other numbers sharing this worker.
+    """
+    held = {}  # phone -> deque of [job, reserved wait or None], oldest first
+    due = []  # heap of (time, seq, phone), one entry per phone in held
+    seq = itertools.count()
+    while True:
+        timeout = max(0.0, due[0][0] - time.monotonic()) if due else None
+        try:
+            job = jobs.get(timeout=timeout)
+        except queue.Empty:
+            pass
+        else:
+            jobs.task_done()
+            phone = normalize_phone(job[0]) or job[0]
+            if phone not in held:
+                held[phone] = deque()
+                heapq.heappush(due, (time.monotonic(), next(seq), phone))
+            held[phone].append([job, None])
+            _hold(1)
+            if not jobs.empty():
+                continue  # take in everything queued before sending
+
+        while due and due[0][0] <= time.monotonic():
+            _, _, phone = heapq.heappop(due)
+            pending = held[phone]
+            entry = pending[0]
+            job = entry[0]
+            try:
+                if entry[1] is None:
+                    if not job[3].set_running_or_notify_cancel():
+                        pending.popleft()
+                        _hold(-1)
+                    else:
+                        entry[1] = _reserve_number_token(phone)
+                        if entry[1] > 0:
+                            heapq.heappush(due, (time.monotonic() + entry[1], next(seq), phone))
+                            continue
+                if pending and pending[0] is entry:
+                    pending.popleft()
+                    _hold(-1)
+                    _send_job(job, entry[1])
+            except Exception as e:
+                logger.error(f"SMS dispatch error for {phone}: {e}")
+                if pending and pending[0] is entry:
+                    # Fail the job rather than retrying it in a tight loop
+                    pending.popleft()
+                    _hold(-1)
+                    job[3].set_exception(e)
+            if pending:
+                heapq.heappush(due, (time.monotonic(), next(seq), phone))
+            else:
+                del held[phone]
+
+def _ensure_workers():
+    """Start the worker pool on first use"""
+    with _state_lock:
+        if _state['queues'] is not None:
+            return _state['queues']
+        worker_count = max(1, int(_env_float('SMS_DISPATCH_WORKERS', 4)))
+        queues = [queue.Queue() for _ in range(worker_count)]
+        for i, jobs in enumerate(queues):
+            worker = threading.Thread(target=_worker, args=(jobs,), name=f'sms-dispatch-{i}', daemon=True)
+            worker.start()
+            _state['workers'].append(worker)
+        _state['queues'] = queues
+        logger.info(f"Started {worker_count} SMS dispatch workers")
+        return queues
+
+def enqueue_sms(to, body, **send_kwargs):
+    """
+    Queue an SMS for rate-limited delivery. Extra keyword arguments are passed
+    to send_sms. Returns a Future resolving to the message id (None on failure).
+    """
+    queues = _ensure_workers()
+    key = normalize_phone(to) or to
+    jobs = queues[zlib.crc32(key.encode('utf-8')) % len(queues)]
+    future = Future()
+    jobs.put((to, body, send_kwargs, future, time.monotonic()))
+    with _metrics_lock:
+        _metrics['enqueued'] += 1
+    return future
+
+async def dispatch_sms_async(to, body, **send_kwargs):
+    """
+    Rate-limited send for asyncio callers: waits for the per-number and
+    global buckets on the event loop, then sends with send_sms_async.
+    """
+    started = time.monotonic()
+    with _metrics_lock:
+        _metrics['enqueued'] += 1
+    # Both tokens are reserved now, so the wait is the longer of the two
+    throttled = max(_reserve_number_token(normalize_phone(to) or to), _ensure_global_bucket().reserve())
+    if throttled > 0:
+        await asyncio.sleep(throttled)
+    _record_dispatch(time.monotonic() - started, throttled)
+    message_id = await send_sms_async(to, body, **send_kwargs)
+    with _metrics_lock:
+        _metrics['sent' if message_id else 'failed'] += 1
+    return message_id
+
+def get_queue_depth():
+    queues = _state['queues']
+    if not queues:
+        return 0
+    with _metrics_lock:
+        held = _state['held']
+    return held + sum(jobs.qsize() for jobs in queues)
+
+def get_dispatch_stats():
+    """Queue depth, throughput and wait-time metrics for the dispatcher"""
+    with _metrics_lock:
+        stats = dict(_metrics)
+    dispatched = stats['sent'] + stats['failed']
+    stats['depth'] = get_queue_depth()
+    stats['number_buckets'] = len(_state['number_buckets'])
+    stats['avg_wait_seconds'] = stats['wait_seconds_total'] / dispatched if dispatched else 0.0
+    return stats
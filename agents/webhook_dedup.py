@@ -0,0 +1,107 @@
+"""
+Skip redelivered Textbelt webhooks.
+
+Textbelt retries a webhook it thinks failed, so the same messageId can
+arrive several times. `claim_message_id` checks a bounded in-memory set
+first and falls back to a persisted SQLite index (WEBHOOK_DEDUP_DB_PATH),
+so duplicates are recognised across restarts and gunicorn workers.
+"""
+import os, logging, sqlite3, threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEDUP_PATH = os.path.join("chat_history", "webhooks.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen_messages (
+    message_id TEXT PRIMARY KEY,
+    received_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_seen_messages_received ON seen_messages (received_at);
+"""
+
+# Ids with no identity of their own; never deduplicated
+UNTRACKED_IDS = {None, '', 'unknown'}
+
+_seen = OrderedDict()
+_seen_lock = threading.Lock()
+_stats = {'claimed': 0, 'duplicates': 0, 'memory_hits': 0}
+_local = threading.local()
+
+def get_dedup_path():
+    return os.getenv('WEBHOOK_DEDUP_DB_PATH', DEFAULT_DEDUP_PATH)
+
+def get_connection():
+    """This thread's connection; ids older than WEBHOOK_DEDUP_DAYS are pruned on open"""
+    db_path = get_dedup_path()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.path == db_path:
+        return conn
+
+    db_dir = os.path.dirname(db_path)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir, exist_ok=True)
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    cutoff = datetime.now() - timedelta(days=float(os.getenv('WEBHOOK_DEDUP_DAYS', '7')))
+    with conn:
+        conn.execute("DELETE FROM seen_messages WHERE received_at < ?", (cutoff.isoformat(),))
+    _local.conn = conn
+    _local.path = db_path
+    return conn
+
+def _remember(message_id):
+    _seen[message_id] = True
+    _seen.move_to_end(message_id)
+    limit = int(os.getenv('WEBHOOK_DEDUP_MEMORY', '10000'))
+    while len(_seen) > limit:
+        _seen.popitem(last=False)
+
+def claim_message_id(message_id):
+    """
+    Record a webhook messageId. Returns True the first time an id is seen and
+    False for a redelivery. Missing or 'unknown' ids are always new.
+    """
+    if message_id in UNTRACKED_IDS:
+        return True
+    with _seen_lock:
+        if message_id in _seen:
+            _seen.move_to_end(message_id)
+            _stats['duplicates'] += 1
+            _stats['memory_hits'] += 1
+            return False
+    try:
+        conn = get_connection()
+        with conn:
+            cursor = conn.execute("INSERT OR IGNORE INTO seen_messages (message_id, received_at) VALUES (?, ?)",
+                                  (message_id, datetime.now().isoformat()))
+        is_new = cursor.rowcount == 1
+    except sqlite3.Error as e:
+        # Processing a duplicate beats dropping a message
+        logger.error(f"Webhook dedup index unavailable: {e}")
+        is_new = True
+    with _seen_lock:
+        _remember(message_id)
+        _stats['claimed' if is_new else 'duplicates'] += 1
+    return is_new
+
+def release_message_id(message_id):
+    """Forget a claimed id so a retry is processed (used when handling failed)"""
+    if message_id in UNTRACKED_IDS:
+        return
+    with _seen_lock:
+        _seen.pop(message_id, None)
+    try:
+        conn = get_connection()
+        with conn:
+            conn.execute("DELETE FROM seen_messages WHERE message_id = ?", (message_id,))
+    except sqlite3.Error as e:
+        logger.error(f"Webhook dedup index unavailable: {e}")
+
+def get_dedup_stats():
+    with _seen_lock:
+        return dict(_stats, in_memory=len(_seen))